@@ -1,121 +1,423 @@
 # Backend: app.py
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 from flask_cors import CORS
+from werkzeug.serving import make_server
 import numpy as np
 import pandas as pd
+from scipy import sparse
 import re
 import os
+import sys
+import bisect
+import json
+import mmap
+import struct
+import zlib
+import zipfile
+import gzip
+import time
+import tracemalloc
 import gc  # Garbage collector
+import heapq
+from collections import OrderedDict
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii as encode_json_string
+import hmac
+import threading
+import logging
+import random
+import cProfile
+import pstats
+import io
+import socket
+import signal
+import argparse
+import asyncio
+import base64
+import hashlib
+import urllib.parse
+import itertools
+import multiprocessing
+from concurrent.futures import Future, wait as wait_futures
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 CORS(app)
 
-# Load and preprocess Netflix dataset
-def load_netflix_data():
+# Normalize a title the same way for the suggestion list and metadata lookups
+def normalize_title(title):
+    # Convert to lowercase
+    title = title.lower()
+    # Remove special characters but keep spaces
+    title = re.sub(r'[^\w\s]', '', title)
+    # Remove extra whitespace
+    return re.sub(r'\s+', ' ', title).strip()
+
+# Prebuild the metadata record returned for a title, using native Python types
+def build_title_metadata(row):
+    def text(value):
+        return str(value) if pd.notnull(value) else ''
+
+    description = text(row.get('description'))
+    release_year = row.get('release_year')
+    return {
+        'title': text(row.get('title')),
+        'type': text(row.get('type')),
+        'year': int(release_year) if pd.notnull(release_year) else '',
+        'rating': text(row.get('rating')),
+        'description': description[:100] + '...' if len(description) > 100 else description
+    }
+
+# Searchable fields besides the title, with the catalog CSV column each comes from
+SEARCH_FIELDS = {'cast': 'cast', 'director': 'director', 'country': 'country', 'genre': 'listed_in',
+                 'description': 'description'}
+
+# Default weight of a match in each field; ?fields=cast:2,title picks and reweights them
+FIELD_WEIGHTS = {'title': 3.0, 'cast': 2.0, 'director': 2.0, 'genre': 1.5, 'country': 1.0, 'description': 0.5}
+
+# Collect the full text of a title's searchable fields, leaving out empty ones
+def build_title_fields(row):
+    fields = {}
+    for field, column in SEARCH_FIELDS.items():
+        value = row.get(column)
+        if value is not None and pd.notnull(value) and str(value).strip():
+            fields[field] = str(value)
+    return fields
+
+# Catalog files tried in order when NETFLIX_CATALOG is not set. netflix.csv is a zip
+# archive holding netflix_titles_nov_2019.csv.
+CATALOG_PATHS = ('NLP/Netflix_Search_suggestion/netflix_titles.csv', 'netflix_titles.csv',
+                 'data/netflix_titles.csv', 'netflix.csv')
+
+# The only CSV columns read, with compact types for the low-cardinality and numeric ones
+CATALOG_COLUMNS = ('title', 'type', 'release_year', 'rating') + tuple(SEARCH_FIELDS.values())
+CATALOG_DTYPES = {column: str for column in CATALOG_COLUMNS}
+CATALOG_DTYPES.update({'type': 'category', 'rating': 'category', 'release_year': 'float32'})
+
+# Rows parsed at a time; only one chunk of raw rows is in memory at once
+CATALOG_CHUNK_ROWS = 20000
+
+def default_catalog_path():
+    if os.environ.get('NETFLIX_CATALOG'):
+        return os.environ['NETFLIX_CATALOG']
+    return next((path for path in CATALOG_PATHS if os.path.exists(path)), CATALOG_PATHS[0])
+
+# Open a catalog CSV as a binary stream. Zip archives (their first CSV) and gzip files are
+# read directly, recognized by their leading bytes rather than their file name.
+def open_catalog(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(b'PK\x03\x04'):
+        with zipfile.ZipFile(path) as archive:
+            members = [name for name in archive.namelist() if name.lower().endswith('.csv')] or archive.namelist()
+            # The member stays readable after the archive is closed
+            return archive.open(members[0])
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+# Stream a catalog CSV as DataFrames of chunk_rows rows, reading only CATALOG_COLUMNS
+def iter_catalog_chunks(path, chunk_rows=CATALOG_CHUNK_ROWS):
+    with open_catalog(path) as stream:
+        chunks = pd.read_csv(stream, usecols=lambda column: column in CATALOG_COLUMNS, dtype=CATALOG_DTYPES,
+                             chunksize=chunk_rows, encoding='utf-8')
+        for chunk in chunks:
+            yield chunk.dropna(subset=['title'])
+
+# Stream the rows of a catalog CSV as dicts, chunk by chunk
+def iter_catalog_rows(path, chunk_rows=CATALOG_CHUNK_ROWS):
+    for chunk in iter_catalog_chunks(path, chunk_rows):
+        yield from chunk.to_dict('records')
+
+# Normalize titles as rows stream in and yield (title, metadata, fields) for the first row
+# of each title. Very short titles are left out.
+def iter_catalog(rows):
+    seen = set()
+    for row in rows:
+        title = normalize_title(str(row['title']))
+        if len(title) > 2 and title not in seen:
+            seen.add(title)
+            yield title, build_title_metadata(row), build_title_fields(row)
+
+# (title, metadata, fields) for every row of a DataFrame chunk with a long enough title,
+# repeated titles included: the work iter_catalog does, for one chunk in a build worker
+def clean_catalog_chunk(chunk):
+    cleaned = []
+    for row in chunk.to_dict('records'):
+        title = normalize_title(str(row['title']))
+        if len(title) > 2:
+            cleaned.append((title, build_title_metadata(row), build_title_fields(row)))
+    return cleaned
+
+# iter_catalog over a catalog CSV with the rows cleaned by a pool of build workers. Chunks
+# are sent a window at a time, so no more rows are in memory than in a serial load, and
+# results come back in file order, so the first row of each title still wins.
+def iter_catalog_parallel(path, workers):
+    seen = set()
+    chunks = iter_catalog_chunks(path, max(1, CATALOG_CHUNK_ROWS // (2 * workers)))
+    with build_pool(workers) as pool:
+        while window := list(itertools.islice(chunks, 2 * workers)):
+            for cleaned in pool.map(clean_catalog_chunk, window, chunksize=1):
+                for title, metadata, fields in cleaned:
+                    if title not in seen:
+                        seen.add(title)
+                        yield title, metadata, fields
+
+# The shard (0 to count - 1) a title belongs to in sharded mode, stable across processes
+def shard_of(title, count):
+    return zlib.crc32(title.encode('utf-8')) % count
+
+# Load and preprocess Netflix dataset: returns the unique titles, sorted by length, and
+# their metadata and searchable fields by normalized title. With shard=(index, count) only
+# the titles of that shard are kept. With more than one worker the rows are cleaned in
+# parallel, with the same result. Rows are streamed, but the records of every kept title
+# stay in the returned dicts, so load memory grows with the number of titles: the builders
+# take whole lists, since titles are ranked by prior over the full catalog before indexing.
+def load_netflix_data(titles_path=None, shard=None, workers=1):
+    titles_path = titles_path or default_catalog_path()
     try:
-        # Try to load from CSV
-        titles_path = "NLP/Netflix_Search_suggestion/netflix_titles.csv"
-        df = pd.read_csv(titles_path)
-        
-        # Get titles and limit to reasonable amount
-        all_titles = df['title'].dropna().tolist()
-        
-        # Clean titles for suggestions
-        clean_titles = []
-        for title in all_titles:
-            # Convert to lowercase
-            title = title.lower()
-            # Remove special characters but keep spaces
-            title = re.sub(r'[^\w\s]', '', title)
-            # Remove extra whitespace
-            title = re.sub(r'\s+', ' ', title).strip()
-            if len(title) > 2:  # Filter very short titles
-                clean_titles.append(title)
+        titles = []
+        title_metadata = {}
+        title_fields = {}
+        if workers > 1:
+            catalog_rows = iter_catalog_parallel(titles_path, workers)
+        else:
+            catalog_rows = iter_catalog(iter_catalog_rows(titles_path))
+        for title, metadata, fields in catalog_rows:
+            if shard is not None and shard_of(title, shard[1]) != shard[0]:
+                continue
+            titles.append(title)
+            title_metadata[title] = metadata
+            title_fields[title] = fields
         
-        # Get unique titles and sort by length
-        unique_titles = list(set(clean_titles))
-        unique_titles.sort(key=len)
+        # First occurrence order, so builds are reproducible, then by length
+        titles.sort(key=len)
         
-        print(f"Loaded {len(unique_titles)} unique titles")
+        print(f"Loaded {len(titles)} unique titles from {titles_path}")
         
-        return unique_titles, df
+        return titles, title_metadata, title_fields
     
     except Exception as e:
         print(f"Error loading Netflix data: {e}")
         # Return sample data as fallback
-        return ["stranger things", "the crown", "ozark", "narcos"], None
+        return ["stranger things", "the crown", "ozark", "narcos"], {}, {}
 
-# Load data - simplified to just focus on titles
-titles, netflix_df = load_netflix_data()
+# Strings stored as one UTF-8 buffer plus an offsets array, decoded on access.
+# This is how string data goes into index snapshots, and it lets a memory-mapped
+# table be read without first copying every string into the Python heap.
+class StringTable:
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+        self._buffer = memoryview(buffer)
+        self._offsets = memoryview(offsets)
+    
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+    
+    def __len__(self):
+        return len(self._offsets) - 1
+    
+    def __getitem__(self, i):
+        return str(self._buffer[self._offsets[i]:self._offsets[i+1]], 'utf-8')
+    
+    def tolist(self):
+        data = self.buffer.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+    
+    def to_arrays(self, name):
+        return {f'{name}.buffer': self.buffer, f'{name}.offsets': self.offsets}
+    
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        return cls(arrays[f'{name}.buffer'], arrays[f'{name}.offsets'])
 
-# Force garbage collection
-gc.collect()
+# (context, next character) pairs of a padded title for every context length up to n,
+# the lower orders being what the model backs off to for unseen contexts
+def ngram_contexts(title, n=3):
+    chars = ' ' + title + ' '  # Add space padding
+    for i in range(1, len(chars)):
+        for order in range(1, n + 1):
+            if i >= order:
+                yield chars[i-order:i], chars[i]
+
+# Score penalty (log 0.4, "stupid backoff") for each order dropped to find a seen context
+NGRAM_BACKOFF_PENALTY = np.log(0.4)
 
 # Simple ngram model for better suggestions
 class NgramModel:
-    def __init__(self):
+    def __init__(self, n=3):
+        self.n = n
         self.ngrams = {}
         self.start_tokens = {}
+        # Derived lazily, at most one entry per seen context (per completion size): a model
+        # is not changed once it serves queries, and with_changes starts a new model
+        self.ranked = {}
+        self.completions = {}
     
     def train(self, titles, n=3):
         """Train the model on title ngrams"""
+        self.n = n
         for title in titles:
             # Add title start info
             first_word = title.split()[0] if title and ' ' in title else title
             self.start_tokens[first_word] = self.start_tokens.get(first_word, 0) + 1
             
             # Process character ngrams
-            chars = ' ' + title + ' '  # Add space padding
-            for i in range(len(chars) - n + 1):
-                ngram = chars[i:i+n]
-                if i+n < len(chars):
-                    next_char = chars[i+n]
-                    if ngram not in self.ngrams:
-                        self.ngrams[ngram] = {}
-                    self.ngrams[ngram][next_char] = self.ngrams[ngram].get(next_char, 0) + 1
+            for context, next_char in ngram_contexts(title, n):
+                if context not in self.ngrams:
+                    self.ngrams[context] = {}
+                self.ngrams[context][next_char] = self.ngrams[context].get(next_char, 0) + 1
+        return self
+    
+    def add_counts(self, other):
+        """Add the counts of a model trained on titles that follow this model's, giving the
+        model trained on both (tables keep their first-seen order)"""
+        for first_word, count in other.start_tokens.items():
+            self.start_tokens[first_word] = self.start_tokens.get(first_word, 0) + count
+        for context, next_chars in other.ngrams.items():
+            table = self.ngrams.setdefault(context, {})
+            for next_char, count in next_chars.items():
+                table[next_char] = table.get(next_char, 0) + count
+        return self
+    
+    def ranked_next(self, text):
+        """Next characters after (space-padded) text with their log probabilities, most likely
+        first, from the longest seen context, and the backoff penalty for the orders dropped"""
+        for order in range(self.n, 0, -1):
+            context = text[-order:]
+            ranked = self.ranked.get(context)
+            if ranked is None and context in self.ngrams:
+                next_chars = self.ngrams[context]
+                total = sum(next_chars.values())
+                ranked = [(char, float(np.log(count / total)))
+                          for char, count in sorted(next_chars.items(), key=lambda x: x[1], reverse=True)]
+                self.ranked[context] = ranked
+            if ranked is not None:
+                return ranked, (self.n - order) * NGRAM_BACKOFF_PENALTY
+        return [], 0.0
     
     def predict_next(self, prefix, num=5):
         """Predict next characters based on ngram frequencies"""
         if not prefix:
             return []
-        
-        # Get the last ngram
-        n = 3  # ngram size 
-        chars = ' ' + prefix
-        if len(chars) < n:
+        return [char for char, _ in self.ranked_next(' ' + prefix)[0][:num]]
+    
+    def generate_completions(self, prefix, max_len=20, num=5):
+        """The num most likely distinct completions of the last word of prefix, best first"""
+        if not prefix:
             return []
         
-        last_ngram = chars[-n:]
-        if last_ngram not in self.ngrams:
-            return []
+        # Only the last n characters condition the search, so its result is shared by every
+        # prefix ending in them. Only seen contexts are memoized, so the memo is bounded by the
+        # model and not by the queries
+        context = (' ' + prefix)[-self.n:]
+        key = (context, max_len, num)
+        suffixes = self.completions.get(key)
+        if suffixes is None:
+            suffixes = self.beam_search(context, max_len, num)
+            if context in self.ngrams:
+                self.completions[key] = suffixes
+        return [prefix + suffix for suffix in suffixes]
+    
+    def beam_search(self, context, max_len, num):
+        """Beam search over next characters, num wide, until each candidate ends its word"""
+        beam = [(0.0, '')]
+        finished = []
+        for _ in range(max_len):
+            expanded = []
+            for score, suffix in beam:
+                ranked, penalty = self.ranked_next(context + suffix)
+                if not ranked:
+                    finished.append((score, suffix))
+                for char, log_prob in ranked[:num]:
+                    if char == ' ':
+                        finished.append((score + log_prob + penalty, suffix))
+                    else:
+                        expanded.append((score + log_prob + penalty, suffix + char))
+            beam = heapq.nlargest(num, expanded)
+            
+            # Scores only go down, so stop once no open candidate can still make the top num
+            if not beam or (len(finished) >= num and beam[0][0] <= heapq.nlargest(num, finished)[-1][0]):
+                break
         
-        # Get the most frequent next characters
-        next_chars = self.ngrams[last_ngram]
-        sorted_chars = sorted(next_chars.items(), key=lambda x: x[1], reverse=True)
-        return [c for c, _ in sorted_chars[:num]]
+        # Candidates still open at max_len complete as they are
+        return [suffix for _, suffix in heapq.nlargest(num, finished + beam)]
     
-    def generate_completions(self, prefix, max_len=20, num=5):
-        """Generate possible completions for a prefix"""
-        completions = [prefix]
-        
-        # Generate multiple completions
-        for _ in range(num):
-            current = prefix
-            for _ in range(max_len):
-                next_chars = self.predict_next(current)
-                if not next_chars:
-                    break
-                current += next_chars[0]  # Add the most likely next char
-                # Stop if we hit the end of a word/phrase (space after word)
-                if current.endswith('  '):
-                    current = current[:-1]
-                    break
-            completions.append(current)
+    def with_changes(self, added=(), removed=()):
+        """Return a copy with titles added and removed, sharing untouched frequency tables"""
+        model = NgramModel(self.n)
+        model.ngrams = dict(self.ngrams)
+        model.start_tokens = dict(self.start_tokens)
+        copied, touched = set(), set()
         
-        return list(set(completions))  # Remove duplicates
+        def count(table, key, delta):
+            value = table.get(key, 0) + delta
+            if value > 0:
+                table[key] = value
+            else:
+                table.pop(key, None)
+        
+        for titles, delta in ((added, 1), (removed, -1)):
+            for title in titles:
+                first_word = title.split()[0] if title and ' ' in title else title
+                count(model.start_tokens, first_word, delta)
+                
+                for ngram, next_char in ngram_contexts(title, self.n):
+                    # Copy a table before its first change: readers of this model keep theirs
+                    if ngram not in copied:
+                        model.ngrams[ngram] = dict(model.ngrams.get(ngram, {}))
+                        copied.add(ngram)
+                    count(model.ngrams[ngram], next_char, delta)
+                    touched.add(ngram)
+                    if not model.ngrams[ngram]:
+                        del model.ngrams[ngram]
+                        copied.discard(ngram)
+        
+        # Ranked tables of unchanged contexts still hold (a context dropped to zero is changed too)
+        model.ranked = {context: ranked for context, ranked in self.ranked.items() if context not in touched}
+        return model
+    
+    def to_arrays(self):
+        """Flatten the frequency tables (keeping their order) for an index snapshot"""
+        arrays = StringTable.from_strings(self.ngrams).to_arrays('ngram.contexts')
+        arrays.update(StringTable.from_strings(self.start_tokens).to_arrays('ngram.start_tokens'))
+        offsets = np.zeros(len(self.ngrams) + 1, dtype=np.int64)
+        np.cumsum([len(next_chars) for next_chars in self.ngrams.values()], out=offsets[1:])
+        arrays['ngram.next_offsets'] = offsets
+        arrays['ngram.next_chars'] = np.array([ord(c) for next_chars in self.ngrams.values() for c in next_chars], dtype=np.uint32)
+        arrays['ngram.next_counts'] = np.array([count for next_chars in self.ngrams.values() for count in next_chars.values()], dtype=np.int32)
+        arrays['ngram.start_counts'] = np.array(list(self.start_tokens.values()), dtype=np.int32)
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        model = cls()
+        offsets = arrays['ngram.next_offsets'].tolist()
+        next_chars = [chr(code) for code in arrays['ngram.next_chars'].tolist()]
+        next_counts = arrays['ngram.next_counts'].tolist()
+        for context, start, end in zip(StringTable.from_arrays(arrays, 'ngram.contexts').tolist(), offsets, offsets[1:]):
+            model.ngrams[context] = dict(zip(next_chars[start:end], next_counts[start:end]))
+        model.start_tokens = dict(zip(StringTable.from_arrays(arrays, 'ngram.start_tokens').tolist(),
+                                      arrays['ngram.start_counts'].tolist()))
+        return model
 
-# Create trie for fast prefix searching
-class AutocompleteTrie:
+# Keys a title is reachable under in the autocomplete trie
+def title_trie_keys(title):
+    # Each word prefix of the title
+    words = title.split()
+    for i in range(len(words)):
+        yield " ".join(words[:i+1]).lower()
+    
+    # Also the full title
+    yield title.lower()
+
+# Original pointer-based trie, kept as the reference for memory reports
+class DictTrie:
     def __init__(self):
         self.children = {}
         self.is_end_of_word = False
@@ -125,7 +427,7 @@ class AutocompleteTrie:
         node = self
         for char in word:
             if char not in node.children:
-                node.children[char] = AutocompleteTrie()
+                node.children[char] = DictTrie()
             node = node.children[char]
         node.is_end_of_word = True
         node.title = title
@@ -154,113 +456,2460 @@ class AutocompleteTrie:
         dfs(node, prefix, results)
         return results
 
-# Create and populate the trie
-print("Building trie and ngram model...")
-trie = AutocompleteTrie()
-for title in titles:
-    # Insert each word in the title
-    words = title.split()
-    for i in range(len(words)):
-        prefix = " ".join(words[:i+1])
-        trie.insert(prefix.lower(), title)
+# Create trie for fast prefix searching.
+# The trie is frozen into flat NumPy arrays: children of a node are a sorted slice of
+# child_labels/child_nodes (CSR layout), and every title is stored once, in DFS order,
+# in key_titles. A node covers the contiguous range node_start:node_end of that array.
+# Title ids follow ranking order, so a node's top-k results are the k smallest ids of its
+# range: small ranges are sorted at query time, and the best TRIE_TOP_K ids of every
+# larger node are precomputed in top_titles (one row per node listed in top_nodes).
+TRIE_TOP_K = 16
+TRIE_SCAN_LIMIT = 64
+
+class AutocompleteTrie:
+    def __init__(self, titles):
+        self.titles = titles
+        
+        # The word prefixes of a title are prefixes of the title itself, so keying the
+        # trie by whole titles reaches every title from every prefix, once
+        entries = {title.lower(): title_id for title_id, title in enumerate(titles)}
+        
+        # Sorted keys are exactly the DFS order of the trie (node first, then children by char)
+        keys = sorted(entries)
+        self.key_titles = np.array([entries[key] for key in keys], dtype=np.int32)
+        
+        # Create nodes in DFS order, sharing the common prefix with the previous key
+        parents, labels, starts, ends = [-1], [0], [0], [len(keys)]
+        path = [0]
+        previous = ""
+        for key_index, key in enumerate(keys):
+            common = 0
+            limit = min(len(previous), len(key))
+            while common < limit and previous[common] == key[common]:
+                common += 1
+            
+            # Nodes below the common prefix are complete: their range ends here
+            for node in path[common+1:]:
+                ends[node] = key_index
+            del path[common+1:]
+            
+            for char in key[common:]:
+                parents.append(path[-1])
+                labels.append(ord(char))
+                starts.append(key_index)
+                ends.append(len(keys))
+                path.append(len(parents) - 1)
+            previous = key
+        
+        self.node_start = np.array(starts, dtype=np.int32)
+        self.node_end = np.array(ends, dtype=np.int32)
+        
+        # Group child nodes by parent; creation order already sorts siblings by char
+        parents = np.array(parents, dtype=np.int32)
+        labels = np.array(labels, dtype=np.uint32)
+        order = np.argsort(parents[1:], kind='stable').astype(np.int32) + 1
+        self.child_offsets = np.searchsorted(parents[order], np.arange(len(parents) + 1)).astype(np.int32)
+        self.child_labels = labels[order]
+        self.child_nodes = order
+        
+        # Best ids of the nodes too large to sort per query
+        sizes = self.node_end - self.node_start
+        self.top_nodes = np.flatnonzero(sizes > TRIE_SCAN_LIMIT).astype(np.int32)
+        self.top_titles = np.empty((len(self.top_nodes), TRIE_TOP_K), dtype=np.int32)
+        for row, node in enumerate(self.top_nodes.tolist()):
+            ids = self.key_titles[self.node_start[node]:self.node_end[node]]
+            self.top_titles[row] = np.sort(np.partition(ids, TRIE_TOP_K - 1)[:TRIE_TOP_K])
+        
+        self._index_views()
+    
+    ARRAYS = ('key_titles', 'node_start', 'node_end', 'child_offsets', 'child_labels', 'child_nodes',
+              'top_nodes', 'top_titles')
+    
+    def to_arrays(self):
+        return {f'trie.{name}': getattr(self, name) for name in self.ARRAYS}
+    
+    @classmethod
+    def from_arrays(cls, titles, arrays):
+        trie = cls.__new__(cls)
+        trie.titles = titles
+        for name in cls.ARRAYS:
+            setattr(trie, name, arrays[f'trie.{name}'])
+        trie._index_views()
+        return trie
+    
+    def _index_views(self):
+        # Memoryviews give fast scalar access (and bisect support) on the hot path
+        self._child_offsets = memoryview(self.child_offsets)
+        self._child_labels = memoryview(self.child_labels)
+        self._child_nodes = memoryview(self.child_nodes)
+        self._top_nodes = memoryview(self.top_nodes)
+    
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+    
+    def child(self, node, char):
+        """Return the child of node along char, or -1 if there is none"""
+        code = ord(char)
+        end = self._child_offsets[node + 1]
+        i = bisect.bisect_left(self._child_labels, code, self._child_offsets[node], end)
+        if i == end or self._child_labels[i] != code:
+            return -1
+        return self._child_nodes[i]
+    
+    def find_node(self, prefix):
+        """Return the node id reached by prefix, or -1 if no key starts with it"""
+        node = 0
+        for char in prefix:
+            node = self.child(node, char)
+            if node < 0:
+                return -1  # Prefix not found
+        return node
+    
+    def titles_at(self, node, max_results=8, mask=None):
+        """The max_results best-ranked titles under node, only those allowed by mask if given"""
+        start, end = self.node_start[node], self.node_end[node]
+        ids = None
+        if end - start <= TRIE_SCAN_LIMIT:
+            ids = self.key_titles[start:end]
+            ids = sorted((ids[mask[ids]] if mask is not None else ids).tolist())[:max_results]
+        elif max_results <= TRIE_TOP_K:
+            row = bisect.bisect_left(self._top_nodes, node)
+            ids = self.top_titles[row]
+            if mask is None:
+                ids = ids[:max_results].tolist()
+            else:
+                # The precomputed best ids do unless the filter leaves too few of them
+                ids = ids[mask[ids]]
+                ids = ids[:max_results].tolist() if len(ids) >= max_results else None
+        if ids is None:
+            ids = self.key_titles[start:end]
+            if mask is not None:
+                ids = ids[mask[ids]]
+            if len(ids) > max_results:
+                ids = np.partition(ids, max_results - 1)[:max_results]
+            ids = np.sort(ids).tolist()
+        return [self.titles[title_id] for title_id in ids]
+    
+    def search_prefix(self, prefix, max_results=8, mask=None):
+        node = self.find_node(prefix)
+        if node < 0:
+            return []
+        return self.titles_at(node, max_results, mask)
+    
+    def search_prefixes(self, prefixes, max_results=8, mask=None):
+        """Search many prefixes in one walk; each resumes from the path shared with the previous one"""
+        results = []
+        path = [0]  # Nodes along the part of the previous prefix that exists in the trie
+        previous = ''
+        for prefix in prefixes:
+            common = 0
+            limit = min(len(previous), len(prefix), len(path) - 1)
+            while common < limit and previous[common] == prefix[common]:
+                common += 1
+            del path[common+1:]
+            
+            node = path[-1]
+            for char in prefix[common:]:
+                node = self.child(node, char)
+                if node < 0:
+                    break
+                path.append(node)
+            results.append(self.titles_at(node, max_results, mask) if node >= 0 else [])
+            previous = prefix
+        return results
+
+# Compare the memory of the compact trie with the pointer-based DictTrie
+def trie_memory_report(titles):
+    gc.collect()
+    tracemalloc.start()
+    legacy = DictTrie()
+    for title in titles:
+        for key in title_trie_keys(title):
+            legacy.insert(key, title)
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    legacy_nodes = 0
+    stack = [legacy]
+    while stack:
+        node = stack.pop()
+        legacy_nodes += 1
+        stack.extend(node.children.values())
+    del legacy, stack
+    gc.collect()
+    
+    tracemalloc.start()
+    compact = AutocompleteTrie(titles)
+    compact_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    
+    return {
+        'titles': len(titles),
+        'nodes': legacy_nodes,
+        'dict_trie_bytes': legacy_bytes,
+        'compact_trie_bytes': compact_bytes,
+        'compact_array_bytes': compact.nbytes,
+        'ratio': round(legacy_bytes / max(compact_bytes, 1), 1)
+    }
+
+# Character n-gram inverted index for substring matching.
+# Every 1- to n-gram of a title points to the sorted ids of the titles containing it,
+# stored as one flat posting array with per-gram offsets. A substring query intersects
+# the posting lists of its own n-grams, so only titles that can contain it get verified.
+class SubstringIndex:
+    def __init__(self, titles, n=3):
+        self.titles = titles
+        self.n = n
+        
+        postings = {}
+        for title_id, title in enumerate(titles):
+            # Insertion-ordered, unlike a set of strings, so the layout is the same in every process
+            grams = dict.fromkeys(title[i:i+size] for size in range(1, n + 1) for i in range(len(title) - size + 1))
+            for gram in grams:
+                postings.setdefault(gram, []).append(title_id)
+        
+        self.gram_slots = {gram: slot for slot, gram in enumerate(postings)}
+        lengths = np.array([len(ids) for ids in postings.values()], dtype=np.int64)
+        self.offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.ids = np.fromiter((title_id for ids in postings.values() for title_id in ids),
+                               dtype=np.int32, count=int(self.offsets[-1]))
+    
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.ids.nbytes
+    
+    def to_arrays(self):
+        arrays = StringTable.from_strings(self.gram_slots).to_arrays('substring.grams')
+        arrays['substring.n'] = np.array([self.n], dtype=np.int32)
+        arrays['substring.offsets'] = self.offsets
+        arrays['substring.ids'] = self.ids
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, titles, arrays):
+        index = cls.__new__(cls)
+        index.titles = titles
+        index.n = int(arrays['substring.n'][0])
+        grams = StringTable.from_arrays(arrays, 'substring.grams').tolist()
+        index.gram_slots = {gram: slot for slot, gram in enumerate(grams)}
+        index.offsets = arrays['substring.offsets']
+        index.ids = arrays['substring.ids']
+        return index
+    
+    def posting(self, gram):
+        slot = self.gram_slots.get(gram)
+        if slot is None:
+            return self.ids[:0]
+        return self.ids[self.offsets[slot]:self.offsets[slot+1]]
+    
+    def candidates(self, query, mask=None):
+        """Return ids (in title order) of titles that may contain query, only those allowed by
+        mask if given"""
+        if not query:
+            return np.arange(len(self.titles), dtype=np.int32) if mask is None else np.flatnonzero(mask).astype(np.int32)
+        
+        size = min(self.n, len(query))
+        lists = [self.posting(gram) for gram in {query[i:i+size] for i in range(len(query) - size + 1)}]
+        lists.sort(key=len)
+        
+        # Intersect from the shortest posting list up
+        result = lists[0]
+        for ids in lists[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result, ids, assume_unique=True)
+        return result if mask is None else result[mask[result]]
+    
+    def search(self, query):
+        """Yield ids (in title order) of titles containing query"""
+        titles = self.titles
+        for title_id in self.candidates(query).tolist():
+            if query in titles[title_id]:
+                yield title_id
+
+# Vectorized TF-IDF ranking over character n-grams of the titles.
+# Titles become rows of a sparse, L2-normalized TF-IDF matrix built once at load. The
+# matrix is kept transposed (one row of title weights per n-gram), so scoring a query is
+# a single sparse vector-matrix product that only touches the postings of its n-grams,
+# followed by an argpartition top-k: cosine similarity without any Python loop per title.
+class TfidfRanker:
+    def __init__(self, titles, ngram_range=(2, 3), reference=None):
+        self.titles = titles
+        # A reference ranker fixes the vocabulary and idf, so scores from both are comparable
+        self.ngram_range = reference.ngram_range if reference else ngram_range
+        
+        vocabulary = reference.vocabulary if reference else {}
+        indptr = [0]
+        columns = []
+        counts = []
+        for title in titles:
+            grams = {}
+            for gram in self.ngrams(' ' + title + ' '):
+                column = vocabulary.get(gram) if reference else vocabulary.setdefault(gram, len(vocabulary))
+                if column is None:
+                    continue
+                grams[column] = grams.get(column, 0) + 1
+            columns.extend(grams)
+            counts.extend(grams.values())
+            indptr.append(len(columns))
+        
+        columns = np.array(columns, dtype=np.int32)
+        counts = np.array(counts, dtype=np.float32)
+        document_frequency = np.bincount(columns, minlength=len(vocabulary))
+        
+        # Smoothed idf and sublinear tf, as in scikit-learn's TfidfVectorizer
+        self.vocabulary = vocabulary
+        if reference:
+            self.idf = reference.idf
+        else:
+            self.idf = (np.log((1 + len(titles)) / (1 + document_frequency)) + 1).astype(np.float32)
+        matrix = sparse.csr_matrix(((1 + np.log(counts)) * self.idf[columns], columns, indptr),
+                                   shape=(len(titles), len(vocabulary)))
+        
+        # L2-normalize rows so a dot product is the cosine similarity
+        norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+        norms[norms == 0] = 1
+        matrix = sparse.diags(1 / norms).dot(matrix)
+        self.matrix_t = matrix.T.tocsr().astype(np.float32)
+    
+    def to_arrays(self):
+        arrays = StringTable.from_strings(self.vocabulary).to_arrays('tfidf.vocabulary')
+        arrays['tfidf.ngram_range'] = np.array(self.ngram_range, dtype=np.int32)
+        arrays['tfidf.idf'] = self.idf
+        arrays['tfidf.data'] = self.matrix_t.data
+        arrays['tfidf.indices'] = self.matrix_t.indices
+        arrays['tfidf.indptr'] = self.matrix_t.indptr
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, titles, arrays):
+        ranker = cls.__new__(cls)
+        ranker.titles = titles
+        ranker.ngram_range = tuple(arrays['tfidf.ngram_range'].tolist())
+        grams = StringTable.from_arrays(arrays, 'tfidf.vocabulary').tolist()
+        ranker.vocabulary = {gram: column for column, gram in enumerate(grams)}
+        ranker.idf = arrays['tfidf.idf']
+        ranker.matrix_t = sparse.csr_matrix((arrays['tfidf.data'], arrays['tfidf.indices'], arrays['tfidf.indptr']),
+                                            shape=(len(grams), len(titles)), copy=False)
+        return ranker
+    
+    def ngrams(self, text):
+        low, high = self.ngram_range
+        for size in range(low, high + 1):
+            for i in range(len(text) - size + 1):
+                yield text[i:i+size]
+    
+    def query_vector(self, query):
+        """Return the normalized TF-IDF vector of a (possibly partial) query as a 1-row matrix"""
+        # Only the start is padded: the last word is usually still being typed
+        grams = {}
+        for gram in self.ngrams(' ' + query):
+            column = self.vocabulary.get(gram)
+            if column is not None:
+                grams[column] = grams.get(column, 0) + 1
+        
+        columns = np.fromiter(grams, dtype=np.int32, count=len(grams))
+        weights = (1 + np.log(np.fromiter(grams.values(), dtype=np.float32, count=len(grams)))) * self.idf[columns]
+        norm = np.sqrt(weights.dot(weights))
+        if norm > 0:
+            weights /= norm
+        return sparse.csr_matrix((weights, columns, [0, len(columns)]), shape=(1, len(self.vocabulary)))
     
-    # Also insert the full title
-    trie.insert(title.lower(), title)
+    def search(self, query, max_results=8, mask=None):
+        """Return (title_id, score) pairs by descending cosine similarity"""
+        scores = self.query_vector(query).dot(self.matrix_t)
+        return self.top_k(scores.indices, scores.data, max_results, mask)
+    
+    def search_many(self, queries, max_results=8, chunk_size=1024, mask=None):
+        """Score many queries at once: one sparse matrix product per chunk of queries"""
+        results = []
+        for chunk in range(0, len(queries), chunk_size):
+            vectors = sparse.vstack([self.query_vector(query) for query in queries[chunk:chunk+chunk_size]], format='csr')
+            scores = vectors.dot(self.matrix_t).tocsr()
+            for row in range(scores.shape[0]):
+                start, end = scores.indptr[row], scores.indptr[row+1]
+                results.append(self.top_k(scores.indices[start:end], scores.data[start:end], max_results, mask))
+        return results
+    
+    def top_k(self, ids, values, max_results, mask=None):
+        return top_scores(ids, values, max_results, mask)
+
+# The max_results best (id, score) pairs of parallel id and score arrays, by descending
+# score and then id (title order), leaving out ids not allowed by mask if given
+def top_scores(ids, values, max_results, mask=None):
+    if mask is not None:
+        keep = mask[ids]
+        ids, values = ids[keep], values[keep]
+    if len(values) == 0:
+        return []
+    
+    # Partition out the top-k, keeping every title tied with the k-th score, then order
+    # by score and title order so results are deterministic
+    if len(values) > max_results:
+        kth = np.partition(values, len(values) - max_results)[len(values) - max_results]
+        keep = np.flatnonzero(values >= kth)
+        ids, values = ids[keep], values[keep]
+    order = np.lexsort((ids, -values))[:max_results]
+    return list(zip(ids[order].tolist(), values[order].tolist()))
+
+# Edit distances with adjacent transpositions (optimal string alignment) from a to every
+# word, computed together with NumPy one DP cell at a time, and only in the band of cells
+# within limit of the diagonal: anything further away exceeds limit and is reported as
+# limit + 1. With prefix=True it returns the smallest distance between a and any prefix
+# of each word, for words still being typed.
+def edit_distances(a, words, limit, prefix=False):
+    outside = limit + 1
+    lengths = np.array([len(word) for word in words], dtype=np.int64)
+    width = int(lengths.max(initial=0))
+    codes = np.full((len(words), width), -1, dtype=np.int64)
+    for row, word in enumerate(words):
+        codes[row, :len(word)] = [ord(char) for char in word]
+    chars = [ord(char) for char in a]
+    
+    previous_previous = None
+    previous = np.tile(np.minimum(np.arange(width + 1), outside), (len(words), 1))
+    for i in range(1, len(a) + 1):
+        current = np.full_like(previous, outside)
+        current[:, 0] = min(i, outside)
+        for j in range(max(1, i - limit), min(width, i + limit) + 1):
+            value = np.minimum(previous[:, j] + 1, current[:, j-1] + 1)
+            value = np.minimum(value, previous[:, j-1] + (codes[:, j-1] != chars[i-1]))
+            if i > 1 and j > 1:
+                swapped = (codes[:, j-2] == chars[i-1]) & (codes[:, j-1] == chars[i-2])
+                value = np.where(swapped, np.minimum(value, previous_previous[:, j-2] + 1), value)
+            current[:, j] = np.minimum(value, outside)
+        previous_previous, previous = previous, current
+    
+    if prefix:
+        # Columns past the end of a word do not belong to any of its prefixes
+        previous[np.arange(width + 1) > lengths[:, None]] = outside
+        return previous.min(axis=1)
+    return previous[np.arange(len(words)), lengths]
+
+# All strings reachable from word by deleting up to max_distance characters
+def deletions(word, max_distance):
+    results = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i+1:] for w in frontier for i in range(len(w))}
+        results |= frontier
+    return results
+
+# Ids of the titles containing each distinct word of texts, in text order, numbering the
+# texts from first_id, so postings of consecutive chunks merge by concatenation
+def word_postings(texts, first_id=0):
+    postings = {}
+    for title_id, text in enumerate(texts, first_id):
+        for word in dict.fromkeys(text.split()):
+            postings.setdefault(word, []).append(title_id)
+    return postings
+
+def merge_postings(parts):
+    """Join word_postings of consecutive chunks, as one call over all of them returns"""
+    merged = {}
+    for postings in parts:
+        for word, title_ids in postings.items():
+            if word in merged:
+                merged[word].extend(title_ids)
+            else:
+                merged[word] = title_ids
+    return merged
+
+# Typo-tolerant word matching with a precomputed deletion index (SymSpell-style).
+# Every title word is indexed under the deletions of its prefixes of 3 to 7 characters,
+# each hashed (CRC32) together with the prefix length and stored sorted with the matching
+# word ids. Two strings within edit distance d share a deletion, so a lookup hashes the
+# query token's own deletions for the prefix lengths it can match, finds candidate words
+# with a binary search and verifies them with edit_distance. Hash collisions only add
+# candidates that fail verification.
+class FuzzyIndex:
+    PREFIX_LENGTH = 7
+    
+    def __init__(self, titles, postings=None, deletion_keys=None):
+        """postings (word_postings of titles) and deletion_keys (of the sorted words) can be
+        passed in when they were computed elsewhere, e.g. by parallel build workers"""
+        self.titles = titles
+        
+        if postings is None:
+            postings = word_postings(titles)
+        self.words = sorted(postings)
+        
+        lengths = np.array([len(postings[word]) for word in self.words], dtype=np.int64)
+        self.word_offsets = np.zeros(len(self.words) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.word_offsets[1:])
+        self.word_titles = np.fromiter((title_id for word in self.words for title_id in postings[word]),
+                                       dtype=np.int32, count=int(self.word_offsets[-1]))
+        
+        hashes, word_ids = deletion_keys if deletion_keys is not None else self.deletion_keys(self.words)
+        order = np.lexsort((word_ids, hashes))
+        self.delete_hashes = hashes[order]
+        self.delete_words = word_ids[order]
+        self._index_words()
+    
+    def _index_words(self):
+        self.word_ids = {word: word_id for word_id, word in enumerate(self.words)}
+        # Keystrokes repeat the same words, so word matches are memoized per index
+        self.match_words = lru_cache(maxsize=4096)(self._match_words)
+    
+    @classmethod
+    def deletion_keys(cls, words, first_id=0):
+        """(hashes, word ids) of the deletions of words, numbered from first_id, unsorted"""
+        hashes, word_ids = [], []
+        for word_id, word in enumerate(words, first_id):
+            keys = set()
+            for length in range(3, min(len(word), cls.PREFIX_LENGTH) + 1):
+                keys.update(cls.delete_key(length, key) for key in deletions(word[:length], cls.max_distance(length)))
+            hashes.extend(keys)
+            word_ids.extend([word_id] * len(keys))
+        return np.array(hashes, dtype=np.uint32), np.array(word_ids, dtype=np.int32)
+    
+    @staticmethod
+    def max_distance(length):
+        return 1 if length <= 4 else 2
+    
+    @staticmethod
+    def delete_key(length, deletion):
+        return zlib.crc32(f'{length}:{deletion}'.encode('utf-8'))
+    
+    def to_arrays(self):
+        arrays = StringTable.from_strings(self.words).to_arrays('fuzzy.words')
+        for name in ('word_offsets', 'word_titles', 'delete_hashes', 'delete_words'):
+            arrays[f'fuzzy.{name}'] = getattr(self, name)
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, titles, arrays):
+        index = cls.__new__(cls)
+        index.titles = titles
+        index.words = StringTable.from_arrays(arrays, 'fuzzy.words').tolist()
+        for name in ('word_offsets', 'word_titles', 'delete_hashes', 'delete_words'):
+            setattr(index, name, arrays[f'fuzzy.{name}'])
+        index._index_words()
+        return index
+    
+    def _match_words(self, token, prefix=False):
+        """Return {word_id: distance} for words within the allowed edit distance of token"""
+        if len(token) < 3:
+            # Too short to correct: exact word, or every word it starts when typing
+            if not prefix:
+                word_id = self.word_ids.get(token)
+                return {} if word_id is None else {word_id: 0}
+            start = bisect.bisect_left(self.words, token)
+            end = bisect.bisect_left(self.words, token + '\U0010ffff')
+            return dict.fromkeys(range(start, end), 0)
+        
+        # Indexed prefixes that can be within the allowed distance of the token
+        allowed = self.max_distance(len(token))
+        head = token[:self.PREFIX_LENGTH]
+        lengths = range(max(3, len(head) - allowed), min(self.PREFIX_LENGTH, len(head) + allowed) + 1)
+        keys = deletions(head, allowed)
+        hashes = np.array([self.delete_key(length, key) for length in lengths for key in keys], dtype=np.uint32)
+        starts = np.searchsorted(self.delete_hashes, hashes, side='left')
+        ends = np.searchsorted(self.delete_hashes, hashes, side='right')
+        candidates = set()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            candidates.update(self.delete_words[start:end].tolist())
+        
+        # Only words of a compatible length can be within the allowed distance
+        if prefix:
+            candidates = [(word_id, self.words[word_id][:len(token) + allowed]) for word_id in candidates]
+        else:
+            candidates = [(word_id, self.words[word_id]) for word_id in candidates
+                          if abs(len(self.words[word_id]) - len(token)) <= allowed]
+        if not candidates:
+            return {}
+        
+        distances = edit_distances(token, [word for _, word in candidates], allowed, prefix)
+        return {word_id: distance for (word_id, _), distance in zip(candidates, distances.tolist()) if distance <= allowed}
+    
+    def search(self, query, max_results=8, mask=None):
+        """Return (title_id, distance) pairs for titles matching every query word within the
+        allowed edit distance (the last word may be a prefix), by total distance and title order.
+        Only titles allowed by mask are returned when it is given."""
+        tokens = query.split()
+        if not tokens:
+            return []
+        
+        title_ids = None
+        for position, token in enumerate(tokens):
+            matches = self.match_words(token, prefix=position == len(tokens) - 1)
+            if not matches:
+                return []
+            
+            # Titles containing any matching word, with the best distance per title
+            word_ids = np.fromiter(matches, dtype=np.int64, count=len(matches))
+            starts, ends = self.word_offsets[word_ids], self.word_offsets[word_ids + 1]
+            ids = np.concatenate([self.word_titles[start:end] for start, end in zip(starts, ends)])
+            distances = np.repeat(np.fromiter(matches.values(), dtype=np.int32, count=len(matches)), ends - starts)
+            order = np.lexsort((distances, ids))
+            ids, distances = ids[order], distances[order]
+            first = np.ones(len(ids), dtype=bool)
+            first[1:] = ids[1:] != ids[:-1]
+            ids, distances = ids[first], distances[first]
+            
+            if title_ids is None:
+                if mask is not None:
+                    keep = mask[ids]
+                    ids, distances = ids[keep], distances[keep]
+                title_ids, total = ids, distances
+            else:
+                title_ids, left, right = np.intersect1d(title_ids, ids, assume_unique=True, return_indices=True)
+                total = total[left] + distances[right]
+            if len(title_ids) == 0:
+                return []
+        
+        order = np.lexsort((title_ids, total))[:max_results]
+        return list(zip(title_ids[order].tolist(), total[order].tolist()))
+
+# Share of a token's idf scored when the query token is only a prefix of it
+PREFIX_MATCH_WEIGHT = 0.8
+
+# Vocabulary tokens one query token may expand to (the most frequent are kept)
+MAX_PREFIX_EXPANSIONS = 64
+
+# Token inverted index over one text field: the sorted vocabulary, the ids of the titles
+# containing each token as a CSR posting list in title order, and each token's idf. A query
+# token matches every vocabulary token it is a prefix of, found with bisect.
+class TokenIndex:
+    def __init__(self, texts, reference=None, postings=None):
+        if postings is None:
+            postings = word_postings(normalize_title(text) for text in texts)
+        self.tokens = sorted(postings)
+        self.offsets = np.zeros(len(self.tokens) + 1, dtype=np.int64)
+        np.cumsum([len(postings[token]) for token in self.tokens], out=self.offsets[1:])
+        self.postings = np.array([title_id for token in self.tokens for title_id in postings[token]], dtype=np.int32)
+        
+        # A delta index scores with the document frequencies of the base it extends
+        documents = len(texts)
+        frequencies = np.diff(self.offsets).astype(np.float64)
+        if reference is not None:
+            documents += reference.documents
+            frequencies += [reference.frequency(token) for token in self.tokens]
+        self.documents = documents
+        self.idf = np.log1p(documents / np.maximum(frequencies, 1)).astype(np.float32)
+    
+    def to_arrays(self, name):
+        arrays = StringTable.from_strings(self.tokens).to_arrays(f'{name}.tokens')
+        arrays.update({f'{name}.offsets': self.offsets, f'{name}.postings': self.postings, f'{name}.idf': self.idf})
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays, name, documents):
+        index = cls.__new__(cls)
+        index.tokens = StringTable.from_arrays(arrays, f'{name}.tokens').tolist()
+        index.offsets = arrays[f'{name}.offsets']
+        index.postings = arrays[f'{name}.postings']
+        index.idf = arrays[f'{name}.idf']
+        index.documents = documents
+        return index
+    
+    def frequency(self, token):
+        i = bisect.bisect_left(self.tokens, token)
+        if i < len(self.tokens) and self.tokens[i] == token:
+            return int(self.offsets[i+1] - self.offsets[i])
+        return 0
+    
+    def matches(self, token):
+        """Ids of the titles with a token starting with token, each with its best score: the
+        idf of an exact match, or PREFIX_MATCH_WEIGHT of the lowest idf among longer tokens"""
+        start = bisect.bisect_left(self.tokens, token)
+        end = bisect.bisect_left(self.tokens, token + '\U0010ffff', start)
+        if start == end:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        
+        # Longer tokens all score as the most common of them, so a short prefix does not
+        # favour its rarest completions
+        starts, ends = self.offsets[start:end], self.offsets[start+1:end+1]
+        scores = np.full(end - start, self.idf[start:end].min() * PREFIX_MATCH_WEIGHT, dtype=np.float32)
+        exact = self.tokens[start] == token
+        if exact:
+            scores[0] = self.idf[start]
+        if end - start > MAX_PREFIX_EXPANSIONS:
+            keep = np.argsort(starts - ends, kind='stable')
+            if exact:
+                keep = np.concatenate(([0], keep[keep != 0]))
+            keep = np.sort(keep[:MAX_PREFIX_EXPANSIONS])
+            starts, ends, scores = starts[keep], ends[keep], scores[keep]
+        
+        ids = np.concatenate([self.postings[a:b] for a, b in zip(starts.tolist(), ends.tolist())])
+        scores = np.repeat(scores, ends - starts)
+        order = np.lexsort((-scores, ids))
+        ids, scores = ids[order], scores[order]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        return ids[first], scores[first]
+
+# Search titles by their cast, director, genre and other fields: a TokenIndex per field,
+# plus the raw field texts (JSON per title id) so the catalog can be rebuilt from them
+class FieldIndex:
+    def __init__(self, titles, title_fields, reference=None, postings=None):
+        """postings can hold the token postings of every field, computed elsewhere"""
+        self.records = StringTable.from_strings(
+            json.dumps(title_fields[title]) if title_fields.get(title) else '' for title in titles)
+        self.fields = {}
+        for field in FIELD_WEIGHTS:
+            self.fields[field] = TokenIndex(self.field_texts(titles, title_fields, field),
+                                            reference.fields[field] if reference else None,
+                                            postings[field] if postings else None)
+    
+    @staticmethod
+    def field_texts(titles, title_fields, field):
+        if field == 'title':
+            return titles
+        return [(title_fields.get(title) or {}).get(field, '') for title in titles]
+    
+    def to_arrays(self):
+        arrays = self.records.to_arrays('fields.records')
+        for field, index in self.fields.items():
+            arrays.update(index.to_arrays(f'fields.{field}'))
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, titles, arrays):
+        index = cls.__new__(cls)
+        index.records = StringTable.from_arrays(arrays, 'fields.records')
+        index.fields = {field: TokenIndex.from_arrays(arrays, f'fields.{field}', len(titles)) for field in FIELD_WEIGHTS}
+        return index
+    
+    def get_fields(self, title_id):
+        record = self.records[title_id]
+        return json.loads(record) if record else {}
+    
+    def search(self, query, max_results=8, weights=FIELD_WEIGHTS, mask=None):
+        """Return (title_id, score) pairs for titles matching every query token (as a token
+        prefix) in at least one of the weighted fields, by score and title order. Only titles
+        allowed by mask are returned when it is given."""
+        tokens = list(dict.fromkeys(query.split()))
+        if not tokens:
+            return []
+        
+        title_ids = None
+        for token in tokens:
+            # Sum the weighted field scores of each title containing the token
+            ids, scores = [], []
+            for field, weight in weights.items():
+                field_ids, field_scores = self.fields[field].matches(token)
+                ids.append(field_ids)
+                scores.append(field_scores * weight)
+            ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(scores), minlength=len(ids))
+            
+            if title_ids is None:
+                if mask is not None:
+                    keep = mask[ids]
+                    ids, scores = ids[keep], scores[keep]
+                title_ids, total = ids, scores
+            else:
+                title_ids, left, right = np.intersect1d(title_ids, ids, assume_unique=True, return_indices=True)
+                total = total[left] + scores[right]
+            if len(title_ids) == 0:
+                return []
+        
+        order = np.lexsort((title_ids, -total))[:max_results]
+        return list(zip(title_ids[order].tolist(), total[order].tolist()))
+
+# Maturity order of the catalog's ratings, lowest first, for "rated X or lower" filters
+RATING_ORDER = ('TV-Y', 'TV-Y7', 'TV-Y7-FV', 'G', 'TV-G', 'PG', 'TV-PG', 'PG-13', 'TV-14', 'R', 'TV-MA', 'NC-17')
+
+# A query-time restriction on the titles suggestions may come from: allowed types and
+# ratings (lowercased; None allows all) and an inclusive release year range
+class TitleFilter:
+    def __init__(self, types=None, ratings=None, min_year=None, max_year=None):
+        self.types = types
+        self.ratings = ratings
+        self.min_year = min_year
+        self.max_year = max_year
+        # Canonical form, used for cache keys
+        parts = []
+        for name, values in (('type', types), ('rating', ratings)):
+            if values is not None:
+                parts.append(f"{name}={'|'.join(sorted(values))}")
+        for name, year in (('min_year', min_year), ('max_year', max_year)):
+            if year is not None:
+                parts.append(f'{name}={year}')
+        self.key = ';'.join(parts)
+
+# Filter masks kept per index before the oldest are dropped
+FILTER_MASK_CACHE = 256
+
+# The type, rating and release year of every title as NumPy columns, built with the index:
+# type and rating as codes into their sorted distinct values, unknown years as 0. A filter
+# becomes a boolean mask over title ids, computed from the columns once and then reused.
+class FilterIndex:
+    COLUMNS = ('type', 'rating')
+    
+    def __init__(self, titles, title_metadata):
+        self.values = {}
+        self.codes = {}
+        for column in self.COLUMNS:
+            raw = [str((title_metadata.get(title) or {}).get(column) or '') for title in titles]
+            self.values[column] = sorted(set(raw))
+            codes = {value: code for code, value in enumerate(self.values[column])}
+            self.codes[column] = np.array([codes[value] for value in raw], dtype=np.uint16)
+        years = [(title_metadata.get(title) or {}).get('year') for title in titles]
+        self.years = np.array([year if isinstance(year, int) else 0 for year in years], dtype=np.int16)
+        self.masks = {}
+    
+    def to_arrays(self):
+        arrays = {'filters.years': self.years}
+        for column in self.COLUMNS:
+            arrays.update(StringTable.from_strings(self.values[column]).to_arrays(f'filters.{column}.values'))
+            arrays[f'filters.{column}.codes'] = self.codes[column]
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.values = {column: StringTable.from_arrays(arrays, f'filters.{column}.values').tolist()
+                        for column in cls.COLUMNS}
+        index.codes = {column: arrays[f'filters.{column}.codes'] for column in cls.COLUMNS}
+        index.years = arrays['filters.years']
+        index.masks = {}
+        return index
+    
+    def mask(self, filters):
+        """Boolean array over title ids, True for the titles filters allows"""
+        mask = self.masks.get(filters.key)
+        if mask is not None:
+            return mask
+        
+        mask = np.ones(len(self.years), dtype=bool)
+        for column, allowed in (('type', filters.types), ('rating', filters.ratings)):
+            if allowed is not None:
+                codes = [code for code, value in enumerate(self.values[column]) if value.lower() in allowed]
+                mask &= np.isin(self.codes[column], codes)
+        if filters.min_year is not None:
+            mask &= self.years >= filters.min_year
+        if filters.max_year is not None:
+            mask &= (self.years > 0) & (self.years <= filters.max_year)
+        
+        if len(self.masks) >= FILTER_MASK_CACHE:
+            self.masks.clear()
+        self.masks[filters.key] = mask
+        return mask
+
+# Metadata of every title as columns addressed by title id, instead of one record per
+# title: display titles and the truncated descriptions as StringTables, and type, rating and
+# release year shared with the FilterIndex (codes into the distinct values, 0 for unknown
+# years). Titles without metadata have an empty display title. The JSON fragment of each
+# title is joined from the columns once, when the store is built, with the strings escaped
+# by the json module's C encoder; it is byte for byte what json.dumps gives for the record
+# and is kept (and snapshotted) as a StringTable, so a suggestion only looks it up.
+class MetadataStore:
+    def __init__(self, titles, title_metadata, filter_index):
+        records = [title_metadata.get(title) or {} for title in titles]
+        self.display_titles = StringTable.from_strings(str(record.get('title') or '') for record in records)
+        self.descriptions = StringTable.from_strings(str(record.get('description') or '') for record in records)
+        self._share_columns(filter_index)
+        self.fragments = StringTable.from_strings(self._encode_fragment(title_id) for title_id in range(len(titles)))
+    
+    def _share_columns(self, filter_index):
+        self.filter_index = filter_index
+        self.values = filter_index.values
+        self.encoded_values = {column: [encode_json_string(value) for value in filter_index.values[column]]
+                               for column in FilterIndex.COLUMNS}
+        # Memoryviews index to plain ints, much faster than NumPy scalars
+        self._codes = {column: memoryview(filter_index.codes[column]) for column in FilterIndex.COLUMNS}
+        self._years = memoryview(filter_index.years)
+    
+    @property
+    def nbytes(self):
+        """Bytes of the columns, including those shared with the FilterIndex"""
+        columns = [self.display_titles.buffer, self.display_titles.offsets, self.descriptions.buffer,
+                   self.descriptions.offsets, self.fragments.buffer, self.fragments.offsets, self.filter_index.years]
+        columns.extend(self.filter_index.codes.values())
+        return sum(column.nbytes for column in columns)
+    
+    def to_arrays(self):
+        arrays = self.display_titles.to_arrays('metadata.titles')
+        arrays.update(self.descriptions.to_arrays('metadata.descriptions'))
+        arrays.update(self.fragments.to_arrays('metadata.fragments'))
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays, filter_index):
+        store = cls.__new__(cls)
+        store.display_titles = StringTable.from_arrays(arrays, 'metadata.titles')
+        store.descriptions = StringTable.from_arrays(arrays, 'metadata.descriptions')
+        store.fragments = StringTable.from_arrays(arrays, 'metadata.fragments')
+        store._share_columns(filter_index)
+        return store
+    
+    def get(self, title_id):
+        """The metadata record of a title id, or None"""
+        display_title = self.display_titles[title_id]
+        if not display_title:
+            return None
+        return {'title': display_title,
+                'type': self.values['type'][self._codes['type'][title_id]],
+                'year': self._years[title_id] or '',
+                'rating': self.values['rating'][self._codes['rating'][title_id]],
+                'description': self.descriptions[title_id]}
+    
+    def fragment(self, title_id):
+        """The record of a title id as JSON text, or '' without metadata"""
+        return self.fragments[title_id]
+    
+    def _encode_fragment(self, title_id):
+        display_title = self.display_titles[title_id]
+        if not display_title:
+            return ''
+        year = self._years[title_id] or '""'
+        return (f'{{"title": {encode_json_string(display_title)}, '
+                f'"type": {self.encoded_values["type"][self._codes["type"][title_id]]}, '
+                f'"year": {year}, '
+                f'"rating": {self.encoded_values["rating"][self._codes["rating"][title_id]]}, '
+                f'"description": {encode_json_string(self.descriptions[title_id])}}}')
+
+# Compare the resident size of the catalog as a pandas DataFrame of every CSV column, the
+# way it used to be kept, with the MetadataStore of the same titles
+def metadata_memory_report(path=None):
+    path = path or default_catalog_path()
+    with open_catalog(path) as stream:
+        frame = pd.read_csv(stream)
+    frame_bytes = int(frame.memory_usage(deep=True).sum())
+    columns = len(frame.columns)
+    del frame
+    
+    titles, title_metadata, _ = load_netflix_data(path)
+    filter_index = FilterIndex(titles, title_metadata)
+    store = MetadataStore(titles, title_metadata, filter_index)
+    records = StringTable.from_strings(json.dumps(title_metadata[title]) if title in title_metadata else ''
+                                       for title in titles)
+    return {
+        'titles': len(titles),
+        'dataframe_columns': columns,
+        'dataframe_bytes': frame_bytes,
+        'json_records_bytes': records.buffer.nbytes + records.offsets.nbytes,
+        'metadata_store_bytes': store.nbytes,
+        'ratio': round(frame_bytes / max(store.nbytes, 1), 1)
+    }
+
+# Latent dimensions of the description vectors, and IVF lists probed per query
+SEMANTIC_DIMENSIONS = 100
+SEMANTIC_PROBES = 16
+
+# Indexes with at most this many vectors (such as catalog deltas) are scanned in full
+SEMANTIC_EXACT_LIMIT = 2048
+
+# Description words used for the latent space: in at least this many descriptions, and in
+# at most this share of them (more common words are stop words)
+SEMANTIC_MIN_DF = 2
+SEMANTIC_MAX_DF = 0.5
+
+# Top right singular vectors (rows) of a sparse matrix by randomized SVD: a seeded Gaussian
+# range finder sharpened by power iterations, then an exact SVD of the small projected
+# matrix. Much faster than ARPACK for a few hundred components, and deterministic.
+def randomized_components(matrix, components, oversample=10, iterations=4, seed=0):
+    rng = np.random.default_rng(seed)
+    basis = matrix @ rng.standard_normal((matrix.shape[1], components + oversample))
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(basis)
+        basis = matrix @ (matrix.T @ basis)
+    basis, _ = np.linalg.qr(basis)
+    _, _, vt = np.linalg.svd(np.asarray((matrix.T @ basis).T), full_matrices=False)
+    return vt[:components]
+
+# Spherical k-means over unit vectors: Lloyd iterations from a seeded sample, so the
+# clustering (and the snapshot) is the same on every build
+def spherical_kmeans(vectors, clusters, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[np.sort(rng.choice(len(vectors), clusters, replace=False))]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1)
+        # An empty cluster keeps its previous centroid
+        filled = norms > 0
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids
+
+# "More like this" search over descriptions with latent semantic analysis. Descriptions
+# become sublinear TF-IDF word vectors, projected onto the top SEMANTIC_DIMENSIONS singular
+# vectors of a truncated SVD computed at build time, and are stored L2-normalized in one
+# float32 matrix, so a dot product is a cosine similarity. An IVF index clusters them with
+# spherical k-means into about sqrt(n) lists (CSR layout, like the other indexes); a query
+# scores the centroids and then only the vectors of its SEMANTIC_PROBES closest lists.
+# exact_search scores every vector, to measure the recall of the approximate search.
+class SemanticIndex:
+    def __init__(self, titles, title_fields, reference=None):
+        documents = [normalize_title((title_fields.get(title) or {}).get('description', '')).split()
+                     for title in titles]
+        
+        # A reference index fixes the vocabulary, projection and lists, so a delta's vectors
+        # live in the same space as the base's
+        if reference is not None:
+            self.vocabulary, self.idf = reference.vocabulary, reference.idf
+        else:
+            frequency = {}
+            for words in documents:
+                for word in set(words):
+                    frequency[word] = frequency.get(word, 0) + 1
+            words = sorted(word for word, count in frequency.items()
+                           if SEMANTIC_MIN_DF <= count <= SEMANTIC_MAX_DF * len(documents))
+            self.vocabulary = {word: column for column, word in enumerate(words)}
+            counts = np.array([frequency[word] for word in words], dtype=np.float64)
+            self.idf = (np.log((1 + len(documents)) / (1 + counts)) + 1).astype(np.float32)
+        matrix = self.tfidf(documents)
+        
+        if reference is not None:
+            self.projection = reference.projection
+        else:
+            dimensions = min(SEMANTIC_DIMENSIONS, min(matrix.shape) - 1)
+            if dimensions >= 1 and matrix.nnz:
+                components = randomized_components(matrix.astype(np.float64), dimensions)
+                self.projection = np.ascontiguousarray(components.T, dtype=np.float32)
+            else:
+                self.projection = np.zeros((len(self.vocabulary), 0), dtype=np.float32)
+        self.vectors = self.normalize(np.asarray(matrix @ self.projection, dtype=np.float32))
+        
+        # Titles without a usable description stay out of the lists
+        indexed = np.flatnonzero(np.any(self.vectors != 0, axis=1)).astype(np.int32)
+        if reference is not None:
+            self.centroids = reference.centroids
+        elif len(indexed):
+            self.centroids = spherical_kmeans(self.vectors[indexed], max(1, int(np.sqrt(len(indexed)))))
+        else:
+            self.centroids = np.zeros((0, self.projection.shape[1]), dtype=np.float32)
+        if len(self.centroids) and len(indexed):
+            assignment = np.argmax(self.vectors[indexed] @ self.centroids.T, axis=1)
+        else:
+            assignment = np.zeros(len(indexed), dtype=np.int64)
+        order = np.lexsort((indexed, assignment))
+        self.list_ids = indexed[order]
+        self.list_offsets = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1)).astype(np.int64)
+    
+    @staticmethod
+    def normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+    
+    def to_arrays(self):
+        arrays = StringTable.from_strings(self.vocabulary).to_arrays('semantic.vocabulary')
+        for name in ('idf', 'projection', 'vectors', 'centroids', 'list_offsets', 'list_ids'):
+            arrays[f'semantic.{name}'] = getattr(self, name)
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        words = StringTable.from_arrays(arrays, 'semantic.vocabulary').tolist()
+        index.vocabulary = {word: column for column, word in enumerate(words)}
+        for name in ('idf', 'projection', 'vectors', 'centroids', 'list_offsets', 'list_ids'):
+            setattr(index, name, arrays[f'semantic.{name}'])
+        return index
+    
+    def tfidf(self, documents):
+        """The L2-normalized sublinear TF-IDF rows of documents (lists of words), as a CSR matrix"""
+        indptr = [0]
+        columns = []
+        counts = []
+        for words in documents:
+            row = {}
+            for word in words:
+                column = self.vocabulary.get(word)
+                if column is not None:
+                    row[column] = row.get(column, 0) + 1
+            columns.extend(row)
+            counts.extend(row.values())
+            indptr.append(len(columns))
+        columns = np.array(columns, dtype=np.int32)
+        matrix = sparse.csr_matrix(((1 + np.log(np.array(counts, dtype=np.float32))) * self.idf[columns], columns, indptr),
+                                   shape=(len(documents), len(self.vocabulary)))
+        norms = np.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms).dot(matrix).tocsr()
+    
+    def query_vector(self, text):
+        """The unit latent vector of free text (all zeros when no word is known)"""
+        return self.normalize(np.asarray(self.tfidf([normalize_title(text).split()]) @ self.projection,
+                                         dtype=np.float32).ravel())
+    
+    def search(self, vector, max_results=8, mask=None, exclude=None, probes=SEMANTIC_PROBES):
+        """Return (title_id, similarity) pairs for the vectors in the probes lists closest
+        to vector, best first, leaving out exclude and titles not allowed by mask"""
+        if not len(self.centroids) or not vector.any():
+            return []
+        if len(self.list_ids) <= SEMANTIC_EXACT_LIMIT:
+            probes = len(self.centroids)
+        lists = np.argsort(-(self.centroids @ vector), kind='stable')[:probes]
+        ids = np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i+1]] for i in lists.tolist()])
+        if exclude is not None:
+            ids = ids[ids != exclude]
+        return top_scores(ids, self.vectors[ids] @ vector, max_results, mask)
+    
+    def exact_search(self, vector, max_results=8, mask=None, exclude=None):
+        """search over every indexed vector (brute force)"""
+        return self.search(vector, max_results, mask, exclude, probes=len(self.centroids))
+
+# Recall of the approximate semantic search against brute force, over "more like this"
+# queries for sampled titles and over their titles as text queries
+def semantic_recall_report(index, samples=200, k=10, probes=SEMANTIC_PROBES, seed=0):
+    semantic = index.semantic_index
+    rng = random.Random(seed)
+    sampled = rng.sample(semantic.list_ids.tolist(), min(samples, len(semantic.list_ids)))
+    report = {'titles': len(index.titles), 'indexed': len(semantic.list_ids), 'dimensions': semantic.projection.shape[1],
+              'lists': len(semantic.centroids), 'probes': probes, 'k': k}
+    queries = {'similar': [(semantic.vectors[title_id], title_id) for title_id in sampled],
+               'text': [(semantic.query_vector(index.titles[title_id]), None) for title_id in sampled]}
+    for name, vectors in queries.items():
+        found = expected = 0
+        ann_seconds, exact_seconds = [], []
+        for vector, exclude in vectors:
+            started = time.perf_counter()
+            approximate = semantic.search(vector, k, exclude=exclude, probes=probes)
+            ann_seconds.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            exact = semantic.exact_search(vector, k, exclude=exclude)
+            exact_seconds.append(time.perf_counter() - started)
+            found += len({title_id for title_id, _ in approximate} & {title_id for title_id, _ in exact})
+            expected += len(exact)
+        report[f'{name}_recall'] = round(found / max(expected, 1), 4)
+        report[f'{name}_ann_ms_p50'] = round(float(np.median(ann_seconds)) * 1000, 3) if ann_seconds else 0.0
+        report[f'{name}_exact_ms_p50'] = round(float(np.median(exact_seconds)) * 1000, 3) if exact_seconds else 0.0
+    return report
+
+# Index snapshot layout: magic, format version, JSON header length, JSON header (array
+# table and build info), then each array's raw bytes at a 64-byte aligned offset
+SNAPSHOT_MAGIC = b'NFXSNAP\0'
+SNAPSHOT_VERSION = 9
+SNAPSHOT_ALIGNMENT = 64
+
+def write_snapshot(path, arrays, info):
+    table = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        table[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+    header = json.dumps({'arrays': table, 'info': info}).encode('utf-8')
+    start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+    
+    # Write to a temporary file and rename, so readers never see a partial snapshot
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('<II', SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(start + table[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + offset)
+    os.replace(temp_path, path)
+
+def read_snapshot(path):
+    """Memory-map a snapshot and return its arrays (read-only views of the file) and build info"""
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    prefix = len(SNAPSHOT_MAGIC)
+    if mapped[:prefix] != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not an index snapshot")
+    version, header_length = struct.unpack('<II', mapped[prefix:prefix+8])
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} has snapshot version {version}, expected {SNAPSHOT_VERSION}")
+    header = json.loads(mapped[prefix+8:prefix+8+header_length])
+    start = -(-(prefix + 8 + header_length) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+    
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        if count == 0:
+            arrays[name] = np.empty(entry['shape'], dtype=dtype)
+        else:
+            arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count,
+                                         offset=start + entry['offset']).reshape(entry['shape'])
+    return arrays, header['info']
+
+# Release years mapped onto recency 0..1 for the static prior
+PRIOR_YEARS = (1940, 2025)
+
+# Static prior of a title in [0, 1], known before any query: mostly how recent it is,
+# plus a little for short titles, which are more likely to be what a user is typing
+def title_prior(title, metadata=None):
+    year = (metadata or {}).get('year')
+    recency = 0.0
+    if isinstance(year, int):
+        recency = min(max((year - PRIOR_YEARS[0]) / (PRIOR_YEARS[1] - PRIOR_YEARS[0]), 0.0), 1.0)
+    # Rounded to float32, as stored in the index, so orders agree before and after a snapshot
+    return float(np.float32(0.7 * recency + 0.3 / len(title.split())))
+
+# Ranking order of titles: best prior first, then shortest, then alphabetical
+def rank_key(title, prior):
+    return (-prior, len(title), title)
+
+# Records the seconds spent in each consecutive stage of a request or build into a dict, and
+# optionally how many candidates each stage examined into another
+class StageTimer:
+    def __init__(self, timings, examined=None):
+        self.timings = timings
+        self.examined = examined
+        self.last = time.perf_counter()
+    
+    def lap(self, stage, examined=None):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0) + now - self.last
+        self.last = now
+        if examined is not None and self.examined is not None:
+            self.examined[stage] = self.examined.get(stage, 0) + examined
+
+# Parallel builds. A build with more than one worker runs in phases on forked processes.
+# Partial counts: each worker counts the n-grams and collects the title word and field token
+# postings of one contiguous chunk of the ranked titles, and the chunks are merged in chunk
+# order, which gives exactly what one pass over all titles does. Indexes: the workers build
+# the trie, substring, TF-IDF and semantic indexes and the fuzzy deletion keys (by word
+# range) while this process builds the rest from the merged counts. Each phase forks its
+# workers once its inputs are in BUILD_STATE, so they inherit them instead of receiving
+# pickled copies; they send back snapshot arrays.
+BUILD_WORKERS = int(os.environ.get('BUILD_WORKERS', '1'))
+BUILD_STATE = {}
+
+def build_pool(workers):
+    return multiprocessing.get_context('fork').Pool(workers)
+
+def build_partial(bounds):
+    """N-gram counts, word postings and field token postings of titles[start:end]"""
+    start, end = bounds
+    titles, title_fields = BUILD_STATE['titles'][start:end], BUILD_STATE['title_fields']
+    fields = {field: word_postings((normalize_title(text) for text in FieldIndex.field_texts(titles, title_fields, field)),
+                                   start)
+              for field in FIELD_WEIGHTS}
+    return NgramModel().train(titles), word_postings(titles, start), fields
+
+# Indexes built whole by a worker, as snapshot arrays
+BUILD_COMPONENTS = {
+    'semantic': lambda titles, title_fields: SemanticIndex(titles, title_fields).to_arrays(),
+    'tfidf': lambda titles, title_fields: TfidfRanker(titles).to_arrays(),
+    'substring': lambda titles, title_fields: SubstringIndex(titles).to_arrays(),
+    'trie': lambda titles, title_fields: AutocompleteTrie(titles).to_arrays(),
+}
 
-# Create and train ngram model
-ngram_model = NgramModel()
-ngram_model.train(titles)
+def build_component(task):
+    name, *bounds = task
+    if name == 'deletions':
+        start, end = bounds
+        return FuzzyIndex.deletion_keys(BUILD_STATE['words'][start:end], start)
+    return BUILD_COMPONENTS[name](BUILD_STATE['titles'], BUILD_STATE['title_fields'])
 
-# Get title metadata for enriched suggestions
-def get_title_metadata(title):
-    if netflix_df is None:
+# Contiguous (start, end) ranges splitting count items into parts
+def split_ranges(count, parts):
+    return [(count * i // parts, count * (i + 1) // parts) for i in range(parts)]
+
+# All suggestion indexes for one catalog, built together and saved as one snapshot.
+# Titles are kept in ranking order, so every index that returns titles "in title order"
+# returns them best prior first.
+class SearchIndex:
+    def __init__(self, titles, trie, ngram_model, substring_index, tfidf_ranker, fuzzy_index, field_index, filter_index,
+                 semantic_index, metadata, priors, info=None):
+        self.titles = titles
+        self.title_ids = {title: title_id for title_id, title in enumerate(titles)}
+        # Static prior per title id, as a list for fast scalar access
+        self.priors = priors
+        self.prior_list = priors.tolist()
+        self.max_prior = max(self.prior_list, default=0.0)
+        self.trie = trie
+        self.ngram_model = ngram_model
+        self.substring_index = substring_index
+        self.tfidf_ranker = tfidf_ranker
+        self.fuzzy_index = fuzzy_index
+        self.field_index = field_index
+        self.filter_index = filter_index
+        self.semantic_index = semantic_index
+        # Columnar metadata per title id, assembled into records or JSON on lookup
+        self.metadata = metadata
+        self.info = info or {}
+        if 'content' not in self.info:
+            self.info['content'] = self.content_hash()
+    
+    @classmethod
+    def build(cls, titles, title_metadata, title_fields=None, reference=None, workers=1, timings=None):
+        """Build every index. With more than one worker (and no reference) the build runs in
+        parallel with the same result. Seconds per phase are added to timings if given."""
+        timer = StageTimer({} if timings is None else timings)
+        title_fields = title_fields or {}
+        priors = {title: title_prior(title, title_metadata.get(title)) for title in titles}
+        titles = sorted(titles, key=lambda title: rank_key(title, priors[title]))
+        priors = np.array([priors[title] for title in titles], dtype=np.float32)
+        timer.lap('rank')
+        if workers > 1 and reference is None:
+            return cls.build_parallel(titles, title_metadata, title_fields, priors, workers, timer)
+        
+        trie = AutocompleteTrie(titles)
+        timer.lap('trie')
+        
+        # Create and train ngram model
+        ngram_model = NgramModel().train(titles)
+        timer.lap('ngram')
+        
+        # Create the n-gram index for substring and word matching
+        substring_index = SubstringIndex(titles)
+        timer.lap('substring')
+        
+        # Create the TF-IDF ranker for the cosine-similarity mode
+        tfidf_ranker = TfidfRanker(titles, reference=reference.tfidf_ranker if reference else None)
+        timer.lap('tfidf')
+        
+        # Create the deletion index for typo-tolerant matching
+        fuzzy_index = FuzzyIndex(titles)
+        timer.lap('fuzzy')
+        
+        # Create the per-field token indexes for multi-field search
+        field_index = FieldIndex(titles, title_fields, reference=reference.field_index if reference else None)
+        timer.lap('fields')
+        
+        # Create the type, rating and year columns for query-time filters
+        filter_index = FilterIndex(titles, title_metadata)
+        metadata = MetadataStore(titles, title_metadata, filter_index)
+        timer.lap('metadata')
+        
+        # Create the latent description vectors for "more like this" search
+        semantic_index = SemanticIndex(titles, title_fields, reference=reference.semantic_index if reference else None)
+        timer.lap('semantic')
+        return cls(titles, trie, ngram_model, substring_index, tfidf_ranker, fuzzy_index, field_index, filter_index,
+                   semantic_index, metadata, priors, info=cls.build_info(titles))
+    
+    @classmethod
+    def build_parallel(cls, titles, title_metadata, title_fields, priors, workers, timer):
+        BUILD_STATE.update(titles=titles, title_fields=title_fields)
+        try:
+            with build_pool(workers) as pool:
+                partials = pool.map(build_partial, split_ranges(len(titles), workers), chunksize=1)
+            timer.lap('partials')
+            
+            ngram_model = NgramModel()
+            for model, _, _ in partials:
+                ngram_model.add_counts(model)
+            postings = merge_postings(words for _, words, _ in partials)
+            field_postings = {field: merge_postings(fields[field] for _, _, fields in partials) for field in FIELD_WEIGHTS}
+            del partials
+            BUILD_STATE['words'] = sorted(postings)
+            timer.lap('merge')
+            
+            # Longest tasks first, so the last ones to finish are short
+            tasks = [('semantic',), ('tfidf',), ('substring',), ('trie',)]
+            tasks += [('deletions', start, end) for start, end in split_ranges(len(BUILD_STATE['words']), workers)]
+            with build_pool(workers) as pool:
+                pending = pool.map_async(build_component, tasks, chunksize=1)
+                field_index = FieldIndex(titles, title_fields, postings=field_postings)
+                filter_index = FilterIndex(titles, title_metadata)
+                metadata = MetadataStore(titles, title_metadata, filter_index)
+                semantic, tfidf, substring, trie, *deletion_keys = pending.get()
+            timer.lap('indexes')
+            
+            deletion_keys = (np.concatenate([hashes for hashes, _ in deletion_keys]),
+                             np.concatenate([word_ids for _, word_ids in deletion_keys]))
+            return cls(titles, AutocompleteTrie.from_arrays(titles, trie), ngram_model,
+                       SubstringIndex.from_arrays(titles, substring), TfidfRanker.from_arrays(titles, tfidf),
+                       FuzzyIndex(titles, postings, deletion_keys), field_index, filter_index,
+                       SemanticIndex.from_arrays(semantic), metadata, priors, info=cls.build_info(titles))
+        finally:
+            BUILD_STATE.clear()
+            timer.lap('assemble')
+    
+    @staticmethod
+    def build_info(titles):
+        # SOURCE_DATE_EPOCH pins the build time, so snapshots of one catalog are byte-identical
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        built_at = time.gmtime(int(epoch)) if epoch else time.localtime()
+        return {'titles': len(titles), 'built_at': time.strftime('%Y-%m-%dT%H:%M:%S', built_at)}
+    
+    def content_hash(self):
+        """Hash of the titles, their metadata and searchable fields, which every index derives
+        from; it is stored in the snapshot and names the content in ETags"""
+        arrays = StringTable.from_strings(self.titles).to_arrays('titles')
+        arrays.update(self.metadata.to_arrays())
+        arrays.update(self.filter_index.to_arrays())  # Type, rating and year columns
+        arrays.update(self.field_index.to_arrays())
+        digest = hashlib.blake2b(digest_size=8)
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            digest.update(f'{name}:{array.dtype.str}:{array.shape};'.encode('utf-8'))
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+    
+    def prior(self, title):
+        return self.prior_list[self.title_ids[title]]
+    
+    def rank(self, title):
+        return rank_key(title, self.prior(title))
+    
+    def filter_mask(self, filters):
+        """Boolean mask over title ids for a TitleFilter, or None when filters is None"""
+        return self.filter_index.mask(filters) if filters is not None else None
+    
+    # Each lookup below only returns titles allowed by mask, when one is given
+    def prefix_matches(self, prefix, max_results, mask=None):
+        return self.trie.search_prefix(prefix, max_results, mask)
+    
+    def prefix_matches_many(self, prefixes, max_results, mask=None):
+        return self.trie.search_prefixes(prefixes, max_results, mask)
+    
+    def fuzzy_matches(self, query, max_results, mask=None):
+        return [(self.titles[title_id], distance)
+                for title_id, distance in self.fuzzy_index.search(query, max_results, mask)]
+    
+    def tfidf_search_many(self, queries, max_results, mask=None):
+        return [[(self.titles[title_id], score) for title_id, score in results]
+                for results in self.tfidf_ranker.search_many(queries, max_results, mask=mask)]
+    
+    def substring_candidates(self, query, mask=None):
+        """Titles (in title order) that may contain query"""
+        return [self.titles[title_id] for title_id in self.substring_index.candidates(query, mask).tolist()]
+    
+    def tfidf_search(self, query, max_results, mask=None):
+        return [(self.titles[title_id], score) for title_id, score in self.tfidf_ranker.search(query, max_results, mask)]
+    
+    def field_search(self, query, max_results, weights=FIELD_WEIGHTS, mask=None):
+        return [(self.titles[title_id], score)
+                for title_id, score in self.field_index.search(query, max_results, weights, mask)]
+    
+    def semantic_vector(self, title):
+        """The latent description vector of a (normalized) title, or None when not indexed"""
+        title_id = self.title_ids.get(title)
+        return self.semantic_index.vectors[title_id] if title_id is not None else None
+    
+    def semantic_search(self, vector, max_results, mask=None, exclude=None):
+        """Titles with descriptions closest to a latent vector, as (title, similarity) pairs"""
+        exclude = self.title_ids.get(exclude)
+        return [(self.titles[title_id], score)
+                for title_id, score in self.semantic_index.search(vector, max_results, mask, exclude)]
+    
+    def get_metadata(self, title):
+        title_id = self.title_ids.get(normalize_title(title))
+        return self.metadata.get(title_id) if title_id is not None else None
+    
+    def get_fields(self, title):
+        title_id = self.title_ids.get(normalize_title(title))
+        return self.field_index.get_fields(title_id) if title_id is not None else None
+    
+    def get_fragment(self, title):
+        """The metadata of a (normalized) title as JSON text, or None"""
+        title_id = self.title_ids.get(title)
+        return self.metadata.fragment(title_id) or None if title_id is not None else None
+    
+    def save(self, path):
+        write_snapshot(path, self.to_arrays(), self.info)
+    
+    def to_arrays(self):
+        """Every index as named arrays, the content of a snapshot"""
+        arrays = StringTable.from_strings(self.titles).to_arrays('titles')
+        arrays.update(self.metadata.to_arrays())
+        arrays['priors'] = self.priors
+        arrays.update(self.trie.to_arrays())
+        arrays.update(self.ngram_model.to_arrays())
+        arrays.update(self.substring_index.to_arrays())
+        arrays.update(self.tfidf_ranker.to_arrays())
+        arrays.update(self.fuzzy_index.to_arrays())
+        arrays.update(self.field_index.to_arrays())
+        arrays.update(self.filter_index.to_arrays())
+        arrays.update(self.semantic_index.to_arrays())
+        return arrays
+    
+    @classmethod
+    def load(cls, path):
+        return cls.from_arrays(*read_snapshot(path))
+    
+    @classmethod
+    def from_arrays(cls, arrays, info):
+        titles = StringTable.from_arrays(arrays, 'titles').tolist()
+        filter_index = FilterIndex.from_arrays(arrays)
+        return cls(titles,
+                   AutocompleteTrie.from_arrays(titles, arrays),
+                   NgramModel.from_arrays(arrays),
+                   SubstringIndex.from_arrays(titles, arrays),
+                   TfidfRanker.from_arrays(titles, arrays),
+                   FuzzyIndex.from_arrays(titles, arrays),
+                   FieldIndex.from_arrays(titles, arrays),
+                   filter_index,
+                   SemanticIndex.from_arrays(arrays),
+                   MetadataStore.from_arrays(arrays, filter_index),
+                   arrays['priors'],
+                   info)
+
+# Load the prebuilt index snapshot if there is one (build it with
+# `python app.py build-snapshot`), otherwise build everything from the CSV
+SNAPSHOT_PATH = os.environ.get('NETFLIX_SNAPSHOT', 'data/netflix_index.snap')
+
+# Sharded mode: with NETFLIX_SHARDS above 1 the titles are split across that many shard
+# processes, each building its own indexes, and this process only coordinates them. A shard
+# that does not answer within SHARD_DEADLINE_MS is left out of that response.
+SHARD_COUNT = int(os.environ.get('NETFLIX_SHARDS', '1'))
+SHARD_DEADLINE_MS = float(os.environ.get('SHARD_DEADLINE_MS', '100'))
+
+# Command line tasks that read the CSV themselves and never serve the catalog
+STANDALONE_COMMAND = __name__ == '__main__' and (sys.argv[1:2] == ['build-snapshot'] or
+                                                  '--metadata-memory-report' in sys.argv)
+
+search_index = None
+if SHARD_COUNT > 1:
+    # The coordinator keeps an empty catalog; the shards load their titles when started
+    search_index = SearchIndex.build([], {})
+    print(f"Sharded mode: {SHARD_COUNT} shard processes will build the indexes")
+elif STANDALONE_COMMAND:
+    # Built from the CSV by the command itself, once
+    search_index = SearchIndex.build([], {})
+elif os.path.exists(SNAPSHOT_PATH):
+    try:
+        search_index = SearchIndex.load(SNAPSHOT_PATH)
+        print(f"Loaded index snapshot {SNAPSHOT_PATH} ({len(search_index.titles)} titles)")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error loading index snapshot: {e}")
+
+if search_index is None:
+    # Load data - simplified to just focus on titles
+    titles, title_metadata, title_fields = load_netflix_data(workers=BUILD_WORKERS)
+    
+    # Create and populate the trie and ngram model
+    print("Building trie and ngram model...")
+    search_index = SearchIndex.build(titles, title_metadata, title_fields, workers=BUILD_WORKERS)
+    del title_metadata, title_fields
+
+# Force garbage collection
+gc.collect()
+
+# One immutable generation of the catalog. The base index stays frozen; titles added or
+# updated since it was built live in a small delta index (rebuilt on each change, at a
+# cost proportional to the delta), and base titles deleted or replaced are tombstoned.
+# The n-gram model is updated copy-on-write. Each change publishes a new generation by
+# swapping one reference, so a request that took a generation never sees a partial update.
+class Catalog:
+    def __init__(self, base, delta=None, delta_records=None, deleted=frozenset(), ngram_model=None, version=0, tag=None):
+        self.base = base
+        self.delta = delta
+        self.delta_records = delta_records or {}
+        self.deleted = deleted
+        self.ngram_model = ngram_model or base.ngram_model
+        self.version = version
+        
+        # Live titles, still in ranking order
+        titles = [title for title in base.titles if title not in deleted] if deleted else base.titles
+        if delta:
+            titles = list(heapq.merge(titles, delta.titles, key=self.rank))
+        self.titles = titles
+        self.max_prior = max(base.max_prior, delta.max_prior) if delta else base.max_prior
+        
+        # Names this generation's content in ETags, the same in every worker and across restarts:
+        # the content hash of the base, chained with every change applied since (see with_changes)
+        self.tag = tag or base.info['content']
+    
+    def is_live(self, title):
+        return title in self.delta_records or (title in self.base.title_ids and title not in self.deleted)
+    
+    def prior(self, title):
+        return self.delta.prior(title) if title in self.delta_records else self.base.prior(title)
+    
+    def rank(self, title):
+        return rank_key(title, self.prior(title))
+    
+    def masks(self, filters):
+        """Filter masks for the base and delta indexes (both None without filters)"""
+        if filters is None:
+            return None, None
+        return self.base.filter_mask(filters), self.delta.filter_mask(filters) if self.delta else None
+    
+    def allows(self, title, filters=None):
+        """Whether a live title passes filters"""
+        if filters is None:
+            return True
+        base_mask, delta_mask = self.masks(filters)
+        if title in self.delta_records:
+            return bool(delta_mask[self.delta.title_ids[title]])
+        return bool(base_mask[self.base.title_ids[title]])
+    
+    # Each lookup below only returns titles allowed by filters, a TitleFilter, when given
+    def prefix_matches(self, prefix, max_results, filters=None):
+        base_mask, delta_mask = self.masks(filters)
+        
+        # Over-fetch from the base until tombstoned titles are filtered out
+        limit = max_results
+        while True:
+            matches = self.base.prefix_matches(prefix, limit, base_mask)
+            live = [title for title in matches if title not in self.deleted]
+            if len(live) >= max_results or len(matches) < limit:
+                break
+            limit *= 2
+        live = live[:max_results]
+        
+        # Both sides are in ranking order, so the best of the delta merge straight in
+        if self.delta:
+            delta_matches = self.delta.prefix_matches(prefix, max_results, delta_mask)
+            if delta_matches:
+                live = list(heapq.merge(live, delta_matches, key=self.rank))[:max_results]
+        return live
+    
+    def prefix_matches_many(self, prefixes, max_results, filters=None):
+        """Prefix matches for many (ideally sorted) prefixes, sharing trie walks"""
+        # Tombstones or the delta need the per-prefix path
+        if self.deleted or self.delta:
+            return [self.prefix_matches(prefix, max_results, filters) for prefix in prefixes]
+        base_mask, _ = self.masks(filters)
+        return self.base.prefix_matches_many(prefixes, max_results, base_mask)
+    
+    def substring_candidates(self, query, filters=None):
+        base_mask, delta_mask = self.masks(filters)
+        candidates = self.base.substring_candidates(query, base_mask)
+        if self.deleted:
+            candidates = [title for title in candidates if title not in self.deleted]
+        if self.delta:
+            candidates = list(heapq.merge(candidates, self.delta.substring_candidates(query, delta_mask), key=self.rank))
+        return candidates
+    
+    def tfidf_search(self, query, max_results, filters=None):
+        base_mask, delta_mask = self.masks(filters)
+        results = self.base.tfidf_search(query, max_results + len(self.deleted), base_mask)
+        results = [(title, score) for title, score in results if title not in self.deleted]
+        if self.delta:
+            # The delta ranker shares the base vocabulary and idf, so scores are comparable
+            results = sorted(results + self.delta.tfidf_search(query, max_results, delta_mask), key=lambda x: -x[1])
+        return results[:max_results]
+    
+    def field_search(self, query, max_results, weights=FIELD_WEIGHTS, filters=None):
+        base_mask, delta_mask = self.masks(filters)
+        results = self.base.field_search(query, max_results + len(self.deleted), weights, base_mask)
+        results = [(title, score) for title, score in results if title not in self.deleted]
+        if self.delta:
+            # Delta token indexes score with the base document frequencies
+            results = sorted(results + self.delta.field_search(query, max_results, weights, delta_mask),
+                             key=lambda x: -x[1])
+        return results[:max_results]
+    
+    def fuzzy_matches(self, query, max_results, filters=None):
+        base_mask, delta_mask = self.masks(filters)
+        results = self.base.fuzzy_matches(query, max_results + len(self.deleted), base_mask)
+        results = [(title, distance) for title, distance in results if title not in self.deleted]
+        if self.delta:
+            results = sorted(results + self.delta.fuzzy_matches(query, max_results, delta_mask),
+                             key=lambda x: (x[1], self.rank(x[0])))
+        return results[:max_results]
+    
+    def tfidf_search_many(self, queries, max_results, filters=None):
+        base_mask, delta_mask = self.masks(filters)
+        results = []
+        base_results = self.base.tfidf_search_many(queries, max_results + len(self.deleted), base_mask)
+        if self.delta:
+            delta_results = self.delta.tfidf_search_many(queries, max_results, delta_mask)
+        else:
+            delta_results = [[]] * len(queries)
+        for base_matches, delta_matches in zip(base_results, delta_results):
+            matches = [(title, score) for title, score in base_matches if title not in self.deleted]
+            if delta_matches:
+                matches = sorted(matches + delta_matches, key=lambda x: -x[1])
+            results.append(matches[:max_results])
+        return results
+    
+    def semantic_search(self, query, max_results, filters=None):
+        """Titles whose descriptions are closest in meaning to free text"""
+        # The delta shares the base vocabulary and projection, so one vector serves both
+        return self.similar_to(self.base.semantic_index.query_vector(query), max_results, filters)
+    
+    def similar_titles(self, title, max_results, filters=None):
+        """Titles with descriptions like that of a live title, or None for unknown titles"""
+        key = normalize_title(title)
+        if key in self.delta_records:
+            vector = self.delta.semantic_vector(key)
+        elif self.is_live(key):
+            vector = self.base.semantic_vector(key)
+        else:
+            return None
+        return self.similar_to(vector, max_results, filters, exclude=key)
+    
+    def similar_to(self, vector, max_results, filters=None, exclude=None):
+        base_mask, delta_mask = self.masks(filters)
+        results = self.base.semantic_search(vector, max_results + len(self.deleted), base_mask, exclude)
+        results = [(title, score) for title, score in results if title not in self.deleted]
+        if self.delta:
+            results = sorted(results + self.delta.semantic_search(vector, max_results, delta_mask, exclude),
+                             key=lambda x: -x[1])
+        return results[:max_results]
+    
+    def get_metadata(self, title):
+        key = normalize_title(title)
+        if key in self.delta_records:
+            return self.delta.get_metadata(key)
+        if key in self.deleted:
+            return None
+        return self.base.get_metadata(key)
+    
+    def get_fields(self, title):
+        key = normalize_title(title)
+        if key in self.delta_records:
+            return self.delta.get_fields(key)
+        if key in self.deleted:
+            return None
+        return self.base.get_fields(key)
+    
+    def get_fragment(self, title):
+        if title in self.delta_records:
+            return self.delta.get_fragment(title)
+        if title in self.deleted:
+            return None
+        return self.base.get_fragment(title)
+    
+    def with_changes(self, upserts=(), deletes=()):
+        """Return the next generation with titles upserted (CSV-style rows) and deleted"""
+        upserts, deletes = list(upserts), list(deletes)
+        changes = json.dumps([upserts, deletes], sort_keys=True, default=str)
+        tag = hashlib.blake2b(f'{self.tag}\0{changes}'.encode('utf-8'), digest_size=8).hexdigest()
+        records = dict(self.delta_records)
+        fields = {key: self.delta.get_fields(key) for key in records}
+        deleted = set(self.deleted)
+        touched = []
+        
+        for title in deletes:
+            key = normalize_title(title)
+            records.pop(key, None)
+            fields.pop(key, None)
+            if key in self.base.title_ids:
+                deleted.add(key)
+            touched.append(key)
+        
+        for row in upserts:
+            key = normalize_title(str(row.get('title') or ''))
+            if len(key) <= 2:
+                raise ValueError(f"Title too short to index: {row.get('title')!r}")
+            # An updated base title is replaced by its delta version
+            records.pop(key, None)
+            records[key] = build_title_metadata(row)
+            fields[key] = build_title_fields(row)
+            if key in self.base.title_ids:
+                deleted.add(key)
+            touched.append(key)
+        
+        # Only titles whose liveness changed affect the n-gram counts
+        added, removed = [], []
+        for key in dict.fromkeys(touched):
+            was_live = self.is_live(key)
+            now_live = key in records or (key in self.base.title_ids and key not in deleted)
+            if now_live and not was_live:
+                added.append(key)
+            elif was_live and not now_live:
+                removed.append(key)
+        
+        delta = None
+        if records:
+            delta = SearchIndex.build(list(records), records, fields, reference=self.base)
+        return Catalog(self.base, delta, records, frozenset(deleted),
+                       self.ngram_model.with_changes(added, removed), self.version + 1, tag)
+    
+    def needs_compaction(self):
+        return len(self.delta_records) + len(self.deleted) > max(CATALOG_DELTA_LIMIT, len(self.base.titles) // 20)
+    
+    def compacted(self):
+        """Return the next generation with the delta and tombstones merged into a fresh base"""
+        title_metadata = {}
+        title_fields = {}
+        for title in self.titles:
+            metadata = self.get_metadata(title)
+            if metadata:
+                title_metadata[title] = metadata
+            title_fields[title] = self.get_fields(title)
+        base = SearchIndex.build(self.titles, title_metadata, title_fields)
+        return Catalog(base, version=self.version + 1)
+
+# Changes above this many delta titles and tombstones trigger a background compaction
+CATALOG_DELTA_LIMIT = 1000
+
+catalog = Catalog(search_index)
+del search_index
+catalog_lock = threading.Lock()
+
+def update_catalog(upserts=(), deletes=()):
+    """Add, update or delete titles and publish the result as a new catalog generation"""
+    global catalog
+    with catalog_lock:
+        catalog = catalog.with_changes(upserts, deletes)
+        current = catalog
+    suggestion_cache.clear()
+    
+    if current.needs_compaction():
+        threading.Thread(target=compact_catalog, daemon=True).start()
+    return current
+
+def compact_catalog():
+    global catalog
+    # Writers wait for the rebuild; readers keep using the current generation
+    with catalog_lock:
+        if catalog.needs_compaction():
+            catalog = catalog.compacted()
+    suggestion_cache.clear()
+
+# Get title metadata for enriched suggestions (a single hash lookup per title)
+def get_title_metadata(title, generation=None):
+    return (generation or catalog).get_metadata(title)
+
+# The JSON array of enriched suggestions for (title, fragment) pairs: the metadata
+# fragments joined from the metadata columns are used as they are, and titles without
+# metadata become {"title": ...}
+def suggestions_json(pairs):
+    return '[' + ', '.join(fragment or json.dumps({'title': title}) for title, fragment in pairs) + ']'
+
+# suggestions_json for titles of a catalog generation
+def enriched_json(titles, generation=None):
+    current = generation or catalog
+    return suggestions_json((title, current.get_fragment(title)) for title in titles)
+
+# Suggestion modes: the hybrid cascade below, TF-IDF cosine-similarity ranking,
+# multi-field search over cast, director, genre, country, description and title, or
+# titles whose descriptions are closest in meaning to the query
+SUGGESTION_MODES = ('hybrid', 'tfidf', 'fields', 'semantic')
+
+# Field weights from a ?fields= value such as "cast,title" or "cast:2,description:0.5";
+# fields without a weight keep their default one
+def parse_fields(spec):
+    if not spec:
+        return dict(FIELD_WEIGHTS)
+    weights = {}
+    for part in spec.split(','):
+        field, _, weight = part.strip().partition(':')
+        if field not in FIELD_WEIGHTS:
+            raise ValueError(f"Unknown field '{field}', expected one of {', '.join(FIELD_WEIGHTS)}")
+        try:
+            weights[field] = float(weight) if weight else FIELD_WEIGHTS[field]
+        except ValueError:
+            raise ValueError(f"Invalid weight '{weight}' for field '{field}'")
+        if not weights[field] > 0:
+            raise ValueError(f"Weight for field '{field}' must be positive")
+    return weights
+
+# Query parameters that filter suggestions, e.g. ?type=TV Show&max_rating=TV-14&min_year=2015
+FILTER_PARAMS = ('type', 'rating', 'max_rating', 'min_year', 'max_year')
+
+# A TitleFilter from filter parameters (a request's args or a JSON object), or None when
+# none is set. type and rating take comma-separated values; max_rating allows every rating
+# up to that one in RATING_ORDER.
+def parse_filters(values):
+    values = {name: str(values[name]).strip() for name in FILTER_PARAMS
+              if values.get(name) is not None and str(values[name]).strip()}
+    if not values:
         return None
     
-    # Find the closest matching title
-    clean_title = re.sub(r'[^\w\s]', '', title.lower())
-    matches = netflix_df[netflix_df['title'].str.lower().str.contains(clean_title, na=False)]
-    
-    if len(matches) > 0:
-        row = matches.iloc[0]
-        return {
-            'title': row['title'],
-            'type': row.get('type', ''),
-            'year': row.get('release_year', ''),
-            'rating': row.get('rating', ''),
-            'description': row.get('description', '')[:100] + '...' if len(row.get('description', '')) > 100 else row.get('description', '')
-        }
-    return None
+    def choices(name):
+        return frozenset(part.strip().lower() for part in values[name].split(',') if part.strip()) if name in values else None
+    
+    def year(name):
+        if name not in values:
+            return None
+        try:
+            return int(values[name])
+        except ValueError:
+            raise ValueError(f"Invalid {name} '{values[name]}', expected a year")
+    
+    ratings = choices('rating')
+    if 'max_rating' in values:
+        ranks = [rating.lower() for rating in RATING_ORDER]
+        if values['max_rating'].lower() not in ranks:
+            raise ValueError(f"Unknown max_rating '{values['max_rating']}', expected one of {', '.join(RATING_ORDER)}")
+        allowed = frozenset(ranks[:ranks.index(values['max_rating'].lower()) + 1])
+        ratings = allowed if ratings is None else ratings & allowed
+    return TitleFilter(choices('type'), ratings, year('min_year'), year('max_year'))
+
+# Clean a query the same way for suggestions and cache keys
+def normalize_query(input_text):
+    return re.sub(r'[^\w\s]', '', input_text.lower()).strip()
 
 # Function to generate hybrid suggestions
-def generate_suggestions(input_text, num_suggestions=8):
+def generate_suggestions(input_text, num_suggestions=8, mode='hybrid', generation=None, timings=None, examined=None,
+                         fields=None, filters=None):
+    return find_suggestions(generation or catalog, input_text, num_suggestions, mode, timings=timings,
+                            examined=examined, fields=fields, filters=filters)[0]
+
+# Generate suggestions on one catalog generation. Returns (suggestions, candidates), where
+# candidates lists, in title order, every title that can contain the query (or is None
+# when no stage needed them). A candidate list cached for a shorter prefix of the query
+# can be passed back in to skip the index.
+# Stage timings are added to timings, and candidates examined per stage to examined,
+# when dicts are given. fields holds the field weights of the 'fields' mode. With a
+# TitleFilter every stage only generates titles it allows, so filtered results still fill up.
+def find_suggestions(current, input_text, num_suggestions=8, mode='hybrid', candidates=None, timings=None, examined=None,
+                     fields=None, filters=None):
     # If input is empty or too short, return popular titles
     if not input_text or len(input_text) < 2:
-        return titles[:num_suggestions]
+        if filters is not None:
+            return current.prefix_matches('', num_suggestions, filters), None
+        return current.titles[:num_suggestions], None
     
     # Clean the input
-    input_clean = re.sub(r'[^\w\s]', '', input_text.lower()).strip()
+    input_clean = normalize_query(input_text)
     
-    # METHOD 1: Use trie for exact prefix matching
-    trie_matches = trie.search_prefix(input_clean, max_results=num_suggestions)
+    # Relevance-ordered results straight from the TF-IDF matrix
+    if mode == 'tfidf':
+        timer = StageTimer({} if timings is None else timings, examined)
+        suggestions = [title for title, _ in current.tfidf_search(input_clean, num_suggestions, filters)]
+        timer.lap('tfidf', len(suggestions))
+        return suggestions, None
     
-    # METHOD 2: Simple substring matching (for non-prefix matches)
-    substring_matches = []
-    for title in titles:
-        if input_clean in title and title not in trie_matches:
-            substring_matches.append(title)
-            if len(substring_matches) >= num_suggestions:
+    # Ranked matches from the per-field token indexes
+    if mode == 'fields':
+        timer = StageTimer({} if timings is None else timings, examined)
+        suggestions = [title for title, _ in current.field_search(input_clean, num_suggestions, fields or FIELD_WEIGHTS,
+                                                                  filters)]
+        timer.lap('fields', len(suggestions))
+        return suggestions, None
+    
+    # Nearest descriptions in the latent space
+    if mode == 'semantic':
+        timer = StageTimer({} if timings is None else timings, examined)
+        suggestions = [title for title, _ in current.semantic_search(input_clean, num_suggestions, filters)]
+        timer.lap('semantic', len(suggestions))
+        return suggestions, None
+    
+    return hybrid_suggestions(current, input_clean, num_suggestions, candidates, timings=timings, examined=examined,
+                              filters=filters)
+
+# Score of a hybrid suggestion: the base score of the best source that found it plus
+# PRIOR_WEIGHT times its static prior. Bands are wider apart than the prior can move a
+# title, so a better source always outranks a worse one and the prior orders titles
+# within a band. The exact band clears even a prefix match with the full n-gram bonus.
+SOURCE_SCORES = {'exact': 6.0, 'prefix': 4.0, 'word': 3.0, 'substring': 2.0, 'fuzzy': 1.0, 'fallback': -1.0}
+PRIOR_WEIGHT = 0.9
+# Bonus for prefix matches under the likeliest n-gram completions, best completion most
+NGRAM_BONUS = 0.5
+# Score lost per edit of a typo-tolerant match
+FUZZY_EDIT_PENALTY = 0.25
+
+# Bounded min-heap of the best num_suggestions (score, sequence, title) entries. Stages
+# offer titles in ranking order, so on equal scores the title offered first is kept.
+class TopK:
+    def __init__(self, size):
+        self.size = size
+        self.heap = []
+        self.seen = set()
+    
+    def full(self):
+        return len(self.heap) >= self.size
+    
+    def can_improve(self, bound):
+        """Whether a title scoring at most bound could still enter"""
+        return not self.full() or bound > self.heap[0][0]
+    
+    def offer(self, title, score):
+        if title in self.seen:
+            return
+        self.seen.add(title)
+        entry = (score, -len(self.seen), title)
+        if not self.full():
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+    
+    def scored(self):
+        """(title, score) pairs, best first"""
+        return [(title, score) for score, _, title in sorted(self.heap, key=lambda entry: (-entry[0], len(entry[2]), entry[2]))]
+    
+    def titles(self):
+        return [title for title, _ in self.scored()]
+
+# The hybrid cascade for a cleaned query: each source scores its titles (see
+# SOURCE_SCORES) into a bounded top-k heap, and a stage runs only while its best possible
+# score could still enter the heap. Trie matches (num_suggestions + 1 of them, see
+# rank_hybrid) can be passed in when they were computed ahead of time, e.g. for a whole
+# batch of queries at once. Returns (suggestions,
+# candidates); candidates stays None when the substring stage was skipped.
+def hybrid_suggestions(current, input_clean, num_suggestions=8, candidates=None, trie_matches=None, timings=None, examined=None,
+                       filters=None):
+    top, candidates = rank_hybrid(current, input_clean, num_suggestions, candidates, trie_matches, timings, examined, filters)
+    return top.titles(), candidates
+
+# The scoring behind hybrid_suggestions; returns the filled TopK and the candidates
+def rank_hybrid(current, input_clean, num_suggestions=8, candidates=None, trie_matches=None, timings=None, examined=None,
+                filters=None):
+    timer = StageTimer({} if timings is None else timings, examined)
+    top = TopK(num_suggestions)
+    prior_bound = PRIOR_WEIGHT * current.max_prior
+    
+    # METHOD 1: Use trie for exact prefix matching (already the best priors first)
+    # One match more than needed is fetched: the best prefix match left out of the top k
+    if trie_matches is None:
+        trie_matches = current.prefix_matches(input_clean, num_suggestions + 1, filters)
+    timer.lap('trie', len(trie_matches))
+    trie_matches, left_out = trie_matches[:num_suggestions], trie_matches[num_suggestions:]
+    
+    # A title the query names exactly ranks first, whatever its prior
+    exact = ' '.join(input_clean.split())
+    if current.is_live(exact) and current.allows(exact, filters):
+        top.offer(exact, SOURCE_SCORES['exact'] + PRIOR_WEIGHT * current.prior(exact))
+    
+    # METHOD 2: Ngram completion
+    # Titles starting with the most likely completions of the query's last word are prefix
+    # matches too, with a bonus by completion rank; they may displace weaker trie matches.
+    # Being prefix matches, those outside the top k have at most the prior of the best one
+    # left out, so the stage is skipped when even that prior with the full bonus cannot
+    # reach the k-th trie score (or no prefix match was left out at all). The top k is then
+    # settled and the trie matches keep their prior order, without completion bonuses.
+    prefix_scores = {title: SOURCE_SCORES['prefix'] + PRIOR_WEIGHT * current.prior(title) for title in trie_matches}
+    if left_out and (SOURCE_SCORES['prefix'] + PRIOR_WEIGHT * current.prior(left_out[0]) + NGRAM_BONUS
+                     >= prefix_scores[trie_matches[-1]]):
+        ngram_completions = current.ngram_model.generate_completions(input_clean, max_len=20, num=num_suggestions)
+        completions = current.prefix_matches_many(ngram_completions, num_suggestions, filters)
+        checked = 0
+        for rank, completion_matches in enumerate(completions):
+            bonus = NGRAM_BONUS * (num_suggestions - rank) / num_suggestions
+            for title in completion_matches:
+                checked += 1
+                score = SOURCE_SCORES['prefix'] + PRIOR_WEIGHT * current.prior(title) + bonus
+                if score > prefix_scores.get(title, 0.0):
+                    prefix_scores[title] = score
+        timer.lap('ngram', checked)
+    for title, score in prefix_scores.items():
+        top.offer(title, score)
+    
+    # METHOD 3: Substring and word matching (for non-prefix matches)
+    # Only titles sharing the query's n-grams are verified, in ranking order, so the scan
+    # stops once even a word match with the current title's prior cannot enter the top k
+    checked = 0
+    if top.can_improve(SOURCE_SCORES['word'] + prior_bound):
+        if candidates is None:
+            candidates = current.substring_candidates(input_clean, filters)
+        for checked, title in enumerate(candidates, 1):
+            prior = PRIOR_WEIGHT * current.prior(title)
+            if not top.can_improve(SOURCE_SCORES['word'] + prior):
                 break
+            position = title.find(input_clean)
+            if position < 0 or title in top.seen:
+                continue
+            # A match at the start of a word is a word match, anywhere else a substring match
+            source = 'word' if position == 0 or title[position - 1] == ' ' else 'substring'
+            top.offer(title, SOURCE_SCORES[source] + prior)
+    timer.lap('substring', checked)
     
-    # METHOD 3: Ngram completion
-    ngram_completions = ngram_model.generate_completions(input_clean, max_len=20, num=num_suggestions)
+    # METHOD 4: Typo-tolerant matching (every word within a small edit distance)
+    if top.can_improve(SOURCE_SCORES['fuzzy'] + prior_bound):
+        fuzzy_matches = current.fuzzy_matches(input_clean, num_suggestions + len(top.seen), filters)
+        for title, distance in fuzzy_matches:
+            top.offer(title, SOURCE_SCORES['fuzzy'] + PRIOR_WEIGHT * current.prior(title) - FUZZY_EDIT_PENALTY * distance)
+        timer.lap('fuzzy', len(fuzzy_matches))
     
-    # Find titles that start with these completions
-    ngram_matches = []
-    for completion in ngram_completions:
-        for title in titles:
-            if title.startswith(completion) and title not in trie_matches and title not in ngram_matches:
-                ngram_matches.append(title)
-                if len(ngram_matches) >= num_suggestions:
-                    break
+    # If we still don't have enough suggestions, add the best titles that start with the same
+    # first letter (the trie has them in ranking order)
+    if not top.full() and input_clean:
+        fallback_matches = current.prefix_matches(input_clean[0], num_suggestions + len(top.seen), filters)
+        for title in fallback_matches:
+            top.offer(title, SOURCE_SCORES['fallback'] + PRIOR_WEIGHT * current.prior(title))
+        timer.lap('fallback', len(fallback_matches))
     
-    # METHOD 4: Word-level matching (match any word in the title)
-    word_matches = []
-    for title in titles:
-        words = title.split()
-        for word in words:
-            if input_clean in word and title not in trie_matches and title not in substring_matches and title not in word_matches:
-                word_matches.append(title)
-                if len(word_matches) >= num_suggestions:
-                    break
+    return top, candidates
+
+# Suggestions for many queries, returned in input order. Each distinct cleaned query runs
+# once, in sorted order: the trie is walked once with neighbours sharing their common
+# path, a query extending an earlier one narrows that query's candidates instead of
+# going back to the n-gram index, and TF-IDF scores every query in one matrix product.
+def generate_suggestions_batch(queries, num_suggestions=8, mode='hybrid', generation=None, fields=None, filters=None):
+    current = generation or catalog
     
-    # Combine results with prioritization
-    all_suggestions = []
-    seen = set()
+    # Empty or too-short queries return the first titles, as for a single query
+    keys = [normalize_query(query) if query and len(query) >= 2 else None for query in queries]
+    unique = sorted(set(key for key in keys if key is not None))
+    results = {None: find_suggestions(current, '', num_suggestions, filters=filters)[0]}
+    
+    if mode == 'tfidf':
+        for key, matches in zip(unique, current.tfidf_search_many(unique, num_suggestions, filters)):
+            results[key] = [title for title, _ in matches]
+    elif mode == 'fields':
+        for key in unique:
+            results[key] = [title for title, _ in current.field_search(key, num_suggestions, fields or FIELD_WEIGHTS,
+                                                                       filters)]
+    elif mode == 'semantic':
+        for key in unique:
+            results[key] = [title for title, _ in current.semantic_search(key, num_suggestions, filters)]
+    else:
+        # Queries this one extends, with their candidates; sorted order keeps it a stack
+        extended = []
+        for key, trie_matches in zip(unique, current.prefix_matches_many(unique, num_suggestions + 1, filters)):
+            while extended and not key.startswith(extended[-1][0]):
+                extended.pop()
+            candidates = None
+            if extended and extended[-1][1] is not None:
+                candidates = [title for title in extended[-1][1] if key in title]
+            results[key], candidates = hybrid_suggestions(current, key, num_suggestions, candidates, trie_matches,
+                                                          filters=filters)
+            extended.append((key, candidates))
+    
+    return [results[key] for key in keys]
+
+# Suggestions with the scores that order them, as (title, score) pairs, best first, so
+# results from several shards can be merged. Short queries score titles by their prior,
+# which keeps them in ranking order.
+def scored_suggestions(current, input_text, num_suggestions=8, mode='hybrid', fields=None, filters=None):
+    if not input_text or len(input_text) < 2:
+        titles = find_suggestions(current, input_text, num_suggestions, filters=filters)[0]
+        return [(title, current.prior(title)) for title in titles]
+    input_clean = normalize_query(input_text)
+    if mode == 'tfidf':
+        return current.tfidf_search(input_clean, num_suggestions, filters)
+    if mode == 'fields':
+        return current.field_search(input_clean, num_suggestions, fields or FIELD_WEIGHTS, filters)
+    if mode == 'semantic':
+        return current.semantic_search(input_clean, num_suggestions, filters)
+    return rank_hybrid(current, input_clean, num_suggestions, filters=filters)[0].scored()
+
+# Body of a shard process: load and index the titles of one shard, then answer requests
+# until the coordinator closes the connection. A request is (request_id, queries,
+# num_suggestions, mode, fields, filters) and its reply (request_id, results), with a list
+# of (title, score, metadata JSON fragment) per query, or None when the shard failed.
+def run_shard(shard, count, connection):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C stops the coordinator, which closes the pipe
+    titles, title_metadata, title_fields = load_netflix_data(shard=(shard, count))
+    current = Catalog(SearchIndex.build(titles, title_metadata, title_fields))
+    del titles, title_metadata, title_fields
+    gc.collect()
+    connection.send(('ready', len(current.titles), current.tag))
+    
+    while True:
+        try:
+            request_id, queries, num_suggestions, mode, fields, filters = connection.recv()
+        except EOFError:
+            break
+        try:
+            results = [[(title, score, current.get_fragment(title))
+                        for title, score in scored_suggestions(current, query, num_suggestions, mode, fields, filters)]
+                       for query in queries]
+        except Exception:
+            logger.exception(f"Shard {shard} failed")
+            results = None
+        connection.send((request_id, results))
+
+# Coordinator of sharded mode. Starts one process per shard (they build their indexes in
+# parallel), sends each request to every shard at once and merges their top-k lists.
+# Replies are matched to requests by id on one reader thread per shard, so concurrent
+# requests share the pipes; a reply arriving after its request gave up is dropped.
+class ShardSet:
+    def __init__(self, count):
+        self.count = count
+        self.request_ids = itertools.count()
+        self.pending = {}  # request id -> (shard, future, sent at)
+        self.lock = threading.Lock()
+        
+        context = multiprocessing.get_context('fork')
+        self.connections = []
+        self.processes = []
+        for shard in range(count):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=run_shard, args=(shard, count, child_connection),
+                                      name=f'shard-{shard}', daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        
+        try:
+            ready = [connection.recv() for connection in self.connections]
+        except EOFError:
+            raise RuntimeError("A shard exited while building its indexes")
+        self.titles = [titles for _, titles, _ in ready]
+        # Names the content of all shards in ETags
+        shard_tags = ','.join(tag for _, _, tag in ready).encode('utf-8')
+        self.tag = hashlib.blake2b(shard_tags, digest_size=8).hexdigest()
+        self.alive = [True] * count
+        self.send_locks = [threading.Lock() for _ in range(count)]
+        for shard in range(count):
+            threading.Thread(target=self._read, args=(shard,), name=f'shard-{shard}-reader', daemon=True).start()
     
-    # Add in order of method priority
-    for suggestion in trie_matches + substring_matches + ngram_matches + word_matches:
-        if suggestion not in seen:
-            seen.add(suggestion)
-            all_suggestions.append(suggestion)
-            if len(all_suggestions) >= num_suggestions:
+    def _read(self, shard):
+        connection = self.connections[shard]
+        while True:
+            try:
+                request_id, results = connection.recv()
+            except (EOFError, OSError):
                 break
+            with self.lock:
+                entry = self.pending.pop(request_id, None)
+            if entry is not None:
+                metrics.shard_seconds.observe(time.perf_counter() - entry[2], str(shard))
+                entry[1].set_result(results)
+        
+        # The shard is gone: answer its waiting requests now instead of at their deadline
+        self.alive[shard] = False
+        logger.error(f"Shard {shard} exited")
+        with self.lock:
+            lost = [request_id for request_id, entry in self.pending.items() if entry[0] == shard]
+            for request_id in lost:
+                self.pending.pop(request_id)[1].set_result(None)
     
-    # If we still don't have enough suggestions, add titles that start with the same first letter
-    if len(all_suggestions) < num_suggestions and input_clean:
-        first_letter = input_clean[0]
-        for title in titles:
-            if title.startswith(first_letter) and title not in seen:
-                seen.add(title)
-                all_suggestions.append(title)
-                if len(all_suggestions) >= num_suggestions:
+    def search(self, queries, num_suggestions=8, mode='hybrid', fields=None, filters=None, deadline=None):
+        """Scatter queries to every shard and merge the top num_suggestions per query. Returns
+        (results, missing): per query a list of (title, metadata fragment), and the shards left out
+        because they failed or did not answer within deadline seconds (None waits for all)."""
+        sent = []
+        for shard, connection in enumerate(self.connections):
+            if not self.alive[shard]:
+                continue
+            request_id = next(self.request_ids)
+            future = Future()
+            with self.lock:
+                self.pending[request_id] = (shard, future, time.perf_counter())
+            try:
+                with self.send_locks[shard]:
+                    connection.send((request_id, queries, num_suggestions, mode, fields, filters))
+            except OSError:
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                continue
+            sent.append((shard, request_id, future))
+        wait_futures([future for _, _, future in sent], timeout=deadline)
+        
+        answered = {shard for shard, _, _ in sent}
+        missing = [shard for shard in range(self.count) if shard not in answered]
+        gathered = []
+        for shard, request_id, future in sent:
+            if future.done():
+                results = future.result()
+                status = 'ok' if results is not None else 'error'
+            else:
+                with self.lock:
+                    self.pending.pop(request_id, None)
+                results, status = None, 'timeout'
+            metrics.shard_requests.inc(str(shard), status)
+            if results is None:
+                missing.append(shard)
+            else:
+                gathered.append(results)
+        
+        # Merge in the order of a single index: by score, then shortest, then alphabetical
+        merged = []
+        for position in range(len(queries)):
+            matches = sorted((match for results in gathered for match in results[position]),
+                             key=lambda match: (-match[1], len(match[0]), match[0]))
+            best = {}
+            for title, _, fragment in matches:
+                best.setdefault(title, fragment)
+                if len(best) >= num_suggestions:
                     break
+            merged.append(list(best.items()))
+        return merged, sorted(missing)
+
+shard_set = None
+shard_set_lock = threading.Lock()
+
+# The shards of sharded mode, started on first use; None when not sharded
+def get_shard_set():
+    global shard_set
+    if SHARD_COUNT > 1 and shard_set is None:
+        with shard_set_lock:
+            if shard_set is None:
+                shard_set = ShardSet(SHARD_COUNT)
+    return shard_set
+
+# Bounded LRU cache of full /api/suggest responses with a TTL, keyed by (mode, normalized
+# query) and tied to a catalog version: entries from older generations are never served.
+# Hybrid entries also keep their candidate list, so a miss on "stra" can filter the
+# cached candidates of "str" instead of going back to the index.
+class SuggestionCache:
+    def __init__(self, max_entries=2048, ttl=300, max_candidates=2000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_candidates = max_candidates
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.prefix_hits = 0
+    
+    def _current(self, version):
+        # A newer catalog version drops every entry; requests on an older one bypass the cache
+        if self.version is None or version > self.version:
+            self.entries.clear()
+            self.version = version
+        return version == self.version
+    
+    def get(self, version, key):
+        with self.lock:
+            entry = self.entries.get(key) if self._current(version) else None
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def prefix_candidates(self, version, key):
+        """Return the candidate list cached for the longest shorter prefix of the query, if any"""
+        mode, query = key
+        with self.lock:
+            if not self._current(version):
+                return None
+            now = time.monotonic()
+            for end in range(len(query) - 1, 0, -1):
+                entry = self.entries.get((mode, query[:end]))
+                if entry is not None and entry[2] is not None and entry[0] >= now:
+                    self.prefix_hits += 1
+                    return entry[2]
+        return None
+    
+    def put(self, version, key, response, candidates=None):
+        if candidates is not None and len(candidates) > self.max_candidates:
+            candidates = None
+        with self.lock:
+            if not self._current(version):
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, response, candidates)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
     
-    # Debug output
-    print(f"Query: '{input_text}', Found {len(all_suggestions)} suggestions")
-    if all_suggestions:
-        print(f"Top suggestions: {all_suggestions[:3]}")
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
     
-    return all_suggestions
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'prefix_hits': self.prefix_hits, 'version': self.version}
+
+suggestion_cache = SuggestionCache()
+
+# Prometheus label set, e.g. {stage="trie"}
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+# In-process counter per label combination, rendered in the Prometheus text format
+class Counter:
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value}')
+        return lines
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# In-process histogram per label combination. Only the bucket a value falls in is counted;
+# rendering turns the counts cumulative as Prometheus expects.
+class Histogram:
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, value, *labels):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][bucket] += 1
+            entry[1] += value
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        names = self.label_names + ('le',)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+# Request metrics served by /metrics
+class Metrics:
+    def __init__(self):
+        self.requests = Counter('netflix_suggest_requests_total', 'Suggestion requests.', ('endpoint', 'mode', 'cache'))
+        self.request_seconds = Histogram('netflix_suggest_request_seconds', 'End-to-end request latency.', ('endpoint', 'mode'))
+        self.stage_seconds = Histogram('netflix_suggest_stage_seconds', 'Latency of each request stage.', ('stage',))
+        self.examined = Counter('netflix_suggest_candidates_examined_total', 'Candidates examined by each stage.', ('stage',))
+        self.results = Histogram('netflix_suggest_results', 'Suggestions returned per query.', ('mode',), COUNT_BUCKETS)
+        self.batch_queries = Counter('netflix_suggest_batch_queries_total', 'Queries received in batches.', ('mode',))
+        self.slow_queries = Counter('netflix_suggest_slow_queries_total', 'Queries slower than SLOW_QUERY_MS.', ('mode',))
+        self.shard_requests = Counter('netflix_suggest_shard_requests_total', 'Shard requests by outcome (ok, error, timeout).',
+                                      ('shard', 'status'))
+        self.shard_seconds = Histogram('netflix_suggest_shard_seconds', 'Time for a shard to answer.', ('shard',))
+    
+    def observe_request(self, endpoint, mode, cache_state, seconds, timings=None, examined=None):
+        self.requests.inc(endpoint, mode, cache_state)
+        self.request_seconds.observe(seconds, endpoint, mode)
+        for stage, stage_seconds in (timings or {}).items():
+            self.stage_seconds.observe(stage_seconds, stage)
+        for stage, count in (examined or {}).items():
+            self.examined.inc(stage, amount=count)
+    
+    def render(self, current):
+        lines = []
+        for metric in (self.requests, self.request_seconds, self.stage_seconds, self.examined,
+                       self.results, self.batch_queries, self.slow_queries, self.shard_requests, self.shard_seconds):
+            lines.extend(metric.render())
+        
+        # Values kept by the cache and the live catalog
+        cache_stats = suggestion_cache.stats()
+        titles = sum(shard_set.titles) if shard_set is not None else len(current.titles)
+        values = [('netflix_catalog_titles', 'gauge', 'Titles in the live catalog.', titles),
+                  ('netflix_catalog_version', 'gauge', 'Version of the live catalog generation.', current.version),
+                  ('netflix_suggest_cache_entries', 'gauge', 'Suggestion cache entries.', cache_stats['entries'])]
+        values += [(f'netflix_suggest_cache_{key}_total', 'counter', f'Suggestion cache {key.replace("_", " ")}.', cache_stats[key])
+                   for key in ('hits', 'misses', 'prefix_hits')]
+        for name, kind, description, value in values:
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Structured logging instead of prints on the request path: one JSON line at INFO for a
+# LOG_SAMPLE_RATE fraction (0 to 1) of requests, and one at WARNING for every query slower
+# than SLOW_QUERY_MS (0 disables). With SLOW_QUERY_PROFILE=1 a slow query is run again
+# under cProfile and the hottest functions are logged with it.
+logger = logging.getLogger('netflix_search')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    logger.warning(f"Unknown LOG_LEVEL {LOG_LEVEL!r}, using INFO")
+    LOG_LEVEL = 'INFO'
+logger.setLevel(LOG_LEVEL)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))
+SLOW_QUERY_PROFILE = os.environ.get('SLOW_QUERY_PROFILE') == '1'
+
+# Profile a query again, on the same generation, and return the top functions by cumulative time
+def profile_query(current, query, mode):
+    profiler = cProfile.Profile()
+    profiler.runcall(find_suggestions, current, query, mode=mode)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(15)
+    return output.getvalue()
+
+def log_request(current, query, mode, cache_state, results, seconds, timings):
+    slow = SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS
+    if slow:
+        metrics.slow_queries.inc(mode)
+    elif not (random.random() < LOG_SAMPLE_RATE and logger.isEnabledFor(logging.INFO)):
+        return
+    
+    record = {'event': 'slow_query' if slow else 'suggest', 'query': query, 'mode': mode, 'cache': cache_state,
+              'results': results, 'ms': round(seconds * 1000, 3),
+              'stages': {stage: round(stage_seconds * 1000, 3) for stage, stage_seconds in timings.items()}}
+    if slow and SLOW_QUERY_PROFILE:
+        record['profile'] = profile_query(current, query, mode)
+    logger.log(logging.WARNING if slow else logging.INFO, json.dumps(record))
 
 # Create HTML templates directory if needed
 if not os.path.exists('templates'):
@@ -363,16 +3012,36 @@ index_html = """<!DOCTYPE html>
             
             let debounceTimeout;
             
+            // Use the suggestion stream when `python app.py stream` is running: every keystroke
+            // is sent at once over one connection and only the answer to the newest is shown
+            let stream = null;
+            let seq = 0;
+            const socket = new WebSocket(`${location.protocol === 'https:' ? 'wss' : 'ws'}://${location.hostname}:{{ stream_port }}/suggest`);
+            socket.addEventListener('open', () => { stream = socket; });
+            socket.addEventListener('close', () => { stream = null; });
+            socket.addEventListener('message', event => {
+                const data = JSON.parse(event.data);
+                if (data.seq === seq) {
+                    displaySuggestions(data.suggestions);
+                }
+            });
+            
             searchInput.addEventListener('input', function() {
                 clearTimeout(debounceTimeout);
                 const query = searchInput.value.trim();
                 
                 // Clear suggestions if query is empty
                 if (!query) {
+                    seq++;
                     suggestionsContainer.innerHTML = '';
                     return;
                 }
                 
+                if (stream) {
+                    stream.send(JSON.stringify({seq: ++seq, q: query}));
+                    return;
+                }
+                
                 // Debounce requests to prevent too many API calls
                 debounceTimeout = setTimeout(() => {
                     if (query.length >= 1) {
@@ -489,7 +3158,7 @@ with open('templates/index.html', 'w', encoding='utf-8') as f:
 def index():
     # Debug the template loading
     try:
-        return render_template('index.html')
+        return render_template('index.html', stream_port=STREAM_PORT)
     except Exception as e:
         print(f"Template error: {e}")
         # Return a simple HTML as fallback
@@ -525,56 +3194,539 @@ def index():
         </html>
         """
 
+# Seconds browsers and CDNs may reuse a suggestion response. ETags name the catalog
+# content (see Catalog.tag) and the request, so a conditional request is answered with a
+# 304 before any suggestion work, and a catalog change invalidates every ETag at once.
+SUGGEST_MAX_AGE = int(os.environ.get('SUGGEST_MAX_AGE', '60'))
+
+def suggestion_etag(tag, key, short):
+    request_key = f'{key[0]}\0{key[1]}\0{int(short)}'.encode('utf-8')
+    return f'{tag}-{zlib.crc32(request_key):08x}'
+
+def set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = SUGGEST_MAX_AGE
+    return response
+
 @app.route('/api/suggest', methods=['GET'])
 def suggest():
     query = request.args.get('q', '')
-    suggestions = generate_suggestions(query)
-    
-    # Enrich suggestions with metadata if available
-    enriched_suggestions = []
-    for title in suggestions:
-        metadata = get_title_metadata(title)
-        if metadata:
-            # Convert all values to Python native types to ensure JSON serialization
-            serializable_metadata = {}
-            for key, value in metadata.items():
-                # Convert numpy types to native Python types
-                if hasattr(value, 'item'):  # Check if it's a numpy type with .item() method
-                    serializable_metadata[key] = value.item()
-                elif isinstance(value, pd.Series):
-                    serializable_metadata[key] = value.to_list()
-                else:
-                    serializable_metadata[key] = value
-            enriched_suggestions.append(serializable_metadata)
-        else:
-            enriched_suggestions.append({'title': title})
+    # Asking for fields implies the multi-field mode
+    mode = request.args.get('mode', 'fields' if 'fields' in request.args else 'hybrid')
+    if mode not in SUGGESTION_MODES:
+        return jsonify({'error': f"Unknown mode '{mode}', expected one of {', '.join(SUGGESTION_MODES)}"}), 400
+    try:
+        fields = parse_fields(request.args.get('fields')) if mode == 'fields' else None
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    current = catalog
+    started = time.perf_counter()
+    timings, examined = {}, {}
+    timer = StageTimer(timings)
+    
+    # Very short queries return the first titles and are not worth caching. Multi-field
+    # results also depend on the field weights, and filtered results on the filters.
+    cache_mode = mode if fields is None else f"{mode}:{','.join(f'{field}={weight:g}' for field, weight in sorted(fields.items()))}"
+    if filters is not None:
+        cache_mode += f'|{filters.key}'
+    key = (cache_mode, normalize_query(query))
+    # In sharded mode the content is the shards'
+    shards = get_shard_set()
+    etag = suggestion_etag(shards.tag if shards is not None else current.tag, key, len(query) < 2)
+    if request.if_none_match.contains_weak(etag):
+        response = set_cache_headers(Response(status=304), etag)
+        finish_request(current, query, mode, 'not_modified', None, started, timings)
+        return response
+    
+    # Cached entries are (JSON body, number of suggestions)
+    cached = suggestion_cache.get(current.version, key) if len(query) >= 2 else None
+    timer.lap('cache')
+    if cached is not None:
+        response = set_cache_headers(Response(cached[0], mimetype='application/json'), etag)
+        response.headers['X-Cache'] = 'HIT'
+        timer.lap('serialize')
+        finish_request(current, query, mode, 'hit', cached[1], started, timings)
+        return response
+    
+    missing = []
+    if shards is not None:
+        # Every shard answers with its own top-k, already with metadata fragments
+        results, missing = shards.search([query], mode=mode, fields=fields, filters=filters,
+                                         deadline=SHARD_DEADLINE_MS / 1000)
+        body, count = suggestions_json(results[0]), len(results[0])
+        candidates = None
+        timer.lap('shards')
+    else:
+        # Narrow the candidates of a cached shorter prefix instead of querying the index
+        candidates = None
+        if len(query) >= 2 and mode == 'hybrid':
+            prefix_candidates = suggestion_cache.prefix_candidates(current.version, key)
+            if prefix_candidates is not None:
+                candidates = [title for title in prefix_candidates if key[1] in title]
+        timer.lap('cache')
+        suggestions, candidates = find_suggestions(current, query, mode=mode, candidates=candidates,
+                                                   timings=timings, examined=examined, fields=fields, filters=filters)
+        timer = StageTimer(timings)
+        
+        # Enrich suggestions with their metadata fragments
+        body, count = enriched_json(suggestions, current), len(suggestions)
+        timer.lap('metadata')
     
-    return jsonify(enriched_suggestions)
+    # Results missing a shard are neither cached here nor by clients, so the next request
+    # can get them all
+    if len(query) >= 2 and not missing:
+        suggestion_cache.put(current.version, key, (body, count), candidates)
+    timer.lap('cache')
+    response = Response(body, mimetype='application/json')
+    response.headers['X-Cache'] = 'MISS'
+    if missing:
+        response.headers['X-Shards-Missing'] = ','.join(map(str, missing))
+        response.cache_control.no_store = True
+    else:
+        set_cache_headers(response, etag)
+    timer.lap('serialize')
+    finish_request(current, query, mode, 'miss', count, started, timings, examined)
+    return response
 
-# Also modify the get_title_metadata function to handle serialization better
-def get_title_metadata(title):
-    if netflix_df is None:
-        return None
+# Record a finished /api/suggest request in the metrics and the sampled log
+def finish_request(current, query, mode, cache_state, results, started, timings, examined=None):
+    seconds = time.perf_counter() - started
+    metrics.observe_request('suggest', mode, cache_state, seconds, timings, examined)
+    if results is not None:
+        metrics.results.observe(results, mode)
+    log_request(current, query, mode, cache_state, results, seconds, timings)
+
+# Largest number of queries accepted by /api/suggest/batch
+MAX_BATCH_QUERIES = 100000
+
+# Batch suggestions: POST {"queries": [...], "mode": "hybrid", "filters": {"type": "Movie"}}
+# or GET ?q=...&q=...&type=Movie. Streams a JSON array of {"query", "suggestions"} objects
+# in input order.
+@app.route('/api/suggest/batch', methods=['GET', 'POST'])
+def suggest_batch():
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+            return jsonify({'error': 'Expected a JSON object with a "queries" list'}), 400
+        queries = body['queries']
+        fields = body.get('fields', request.args.get('fields'))
+        mode = body.get('mode', request.args.get('mode', 'fields' if fields is not None else 'hybrid'))
+        filter_values = body.get('filters', request.args)
+        if not isinstance(filter_values, dict):
+            return jsonify({'error': 'Filters must be an object such as {"type": "Movie"}'}), 400
+    else:
+        queries = request.args.getlist('q')
+        fields = request.args.get('fields')
+        mode = request.args.get('mode', 'fields' if fields is not None else 'hybrid')
+        filter_values = request.args
     
+    if mode not in SUGGESTION_MODES:
+        return jsonify({'error': f"Unknown mode '{mode}', expected one of {', '.join(SUGGESTION_MODES)}"}), 400
+    if fields is not None and not isinstance(fields, str):
+        return jsonify({'error': 'Fields must be a string such as "cast,title"'}), 400
     try:
-        # Find the closest matching title
-        clean_title = re.sub(r'[^\w\s]', '', title.lower())
-        matches = netflix_df[netflix_df['title'].str.lower().str.contains(clean_title, na=False)]
-        
-        if len(matches) > 0:
-            row = matches.iloc[0]
-            return {
-                'title': str(row['title']),
-                'type': str(row.get('type', '')),
-                'year': int(row.get('release_year', 0)) if pd.notnull(row.get('release_year', '')) else '',
-                'rating': str(row.get('rating', '')),
-                'description': str(row.get('description', ''))[:100] + '...' if len(str(row.get('description', ''))) > 100 else str(row.get('description', ''))
-            }
-    except Exception as e:
-        print(f"Error getting metadata for '{title}': {e}")
-    return None
+        fields = parse_fields(fields) if mode == 'fields' else None
+        filters = parse_filters(filter_values)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not all(isinstance(query, str) for query in queries):
+        return jsonify({'error': 'Queries must be strings'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f'At most {MAX_BATCH_QUERIES} queries per batch'}), 413
+    
+    current = catalog
+    started = time.perf_counter()
+    shards = get_shard_set()
+    missing = []
+    if shards is not None:
+        # Shards answer a batch one query after another, so the deadline grows with it
+        results, missing = shards.search(queries, mode=mode, fields=fields, filters=filters,
+                                   deadline=SHARD_DEADLINE_MS / 1000 * max(len(queries), 1))
+        enrich = suggestions_json
+    else:
+        results = generate_suggestions_batch(queries, mode=mode, generation=current, fields=fields, filters=filters)
+        enrich = lambda titles: enriched_json(titles, current)
+    metrics.batch_queries.inc(mode, amount=len(queries))
+    
+    def stream():
+        yield '['
+        for i, (query, suggestions) in enumerate(zip(queries, results)):
+            yield (',' if i else '') + f'{{"query": {json.dumps(query)}, "suggestions": {enrich(suggestions)}}}'
+        yield ']'
+        metrics.observe_request('batch', mode, 'none', time.perf_counter() - started)
+    
+    response = Response(stream(), mimetype='application/json')
+    if missing:
+        response.headers['X-Shards-Missing'] = ','.join(map(str, missing))
+        response.cache_control.no_store = True
+    return response
+
+# Largest k accepted by /api/similar
+MAX_SIMILAR_RESULTS = 100
+
+# "More like this": GET /api/similar?title=Dark&k=10, with the same filters as /api/suggest.
+# Returns the enriched titles whose descriptions are closest to that title's, best first.
+@app.route('/api/similar', methods=['GET'])
+def similar():
+    title = request.args.get('title', '')
+    try:
+        k = int(request.args.get('k', '8'))
+        filters = parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not 1 <= k <= MAX_SIMILAR_RESULTS:
+        return jsonify({'error': f'k must be between 1 and {MAX_SIMILAR_RESULTS}'}), 400
+    if SHARD_COUNT > 1:
+        # Every shard learns its own latent space, so a title's vector means nothing to the others
+        return jsonify({'error': 'Similar titles are not available in sharded mode'}), 409
+    
+    current = catalog
+    started = time.perf_counter()
+    key = ('similar' if filters is None else f'similar|{filters.key}', f'{normalize_title(title)}\0{k}')
+    etag = suggestion_etag(current.tag, key, False)
+    if request.if_none_match.contains_weak(etag):
+        metrics.observe_request('similar', 'semantic', 'not_modified', time.perf_counter() - started)
+        return set_cache_headers(Response(status=304), etag)
+    
+    results = current.similar_titles(title, k, filters)
+    if results is None:
+        return jsonify({'error': f"Unknown title '{title}'"}), 404
+    response = set_cache_headers(Response(enriched_json([title for title, _ in results], current),
+                                          mimetype='application/json'), etag)
+    metrics.observe_request('similar', 'semantic', 'none', time.perf_counter() - started)
+    return response
+
+# Prometheus text exposition of the request metrics
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(catalog), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Catalog ingestion: {"upsert": [rows with title, type, release_year, rating, description],
+# "delete": [titles]}. Disabled unless CATALOG_API_TOKEN is set; send it as a Bearer token.
+@app.route('/api/catalog', methods=['POST'])
+def catalog_changes():
+    token = os.environ.get('CATALOG_API_TOKEN')
+    if not token:
+        return jsonify({'error': 'Catalog updates are disabled'}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    if SERVING_WORKERS > 1 or SHARD_COUNT > 1:
+        # Each worker or shard has its own catalog generation, an update would reach only one of them
+        return jsonify({'error': 'Catalog updates need a single unsharded worker; rebuild the snapshot and restart instead'}), 409
+    
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        return jsonify({'error': 'Expected a JSON object with "upsert" and/or "delete"'}), 400
+    try:
+        current = update_catalog(changes.get('upsert', []), changes.get('delete', []))
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'version': current.version, 'titles': len(current.titles)})
+
+# Candidate lists longer than this are not kept on a session's stack
+SESSION_MAX_CANDIDATES = 2000
+
+# Per-connection state of the suggestion stream, for hybrid suggestions on one catalog
+# generation: a stack of (query, trie node, candidates, suggestions) for the prefixes typed
+# so far. Typing advances the trie cursor one edge per character from the previous state
+# and narrows its candidates; a backspace pops back to the shorter query's state, whose
+# suggestions are already known. The cursor walks the base trie, so a generation with a
+# delta or tombstones looks its prefix matches up through the catalog instead.
+class SuggestionSession:
+    def __init__(self, num_suggestions=8, filters=None):
+        self.num_suggestions = num_suggestions
+        self.filters = filters
+        self.generation = None
+        self.states = []
+    
+    def suggest(self, text):
+        """Suggestions for the session's next query, the same as find_suggestions returns"""
+        current = catalog
+        if current is not self.generation:
+            self.generation, self.states = current, [('', 0, None, None)]
+        if not text or len(text) < 2:
+            return find_suggestions(current, text, self.num_suggestions, filters=self.filters)[0]
+        query = normalize_query(text)
+        
+        while not query.startswith(self.states[-1][0]):
+            self.states.pop()
+        prefix, node, candidates, suggestions = self.states[-1]
+        if prefix == query and suggestions is not None:
+            return suggestions
+        
+        # Characters typed at once (a paste) get intermediate states without candidates
+        for i in range(len(prefix), len(query)):
+            if i > len(prefix):
+                self.states.append((query[:i], node, None, None))
+            node = current.base.trie.child(node, query[i]) if node >= 0 else -1
+        if candidates is not None:
+            candidates = [title for title in candidates if query in title]
+        
+        trie_matches = None
+        if not current.delta and not current.deleted:
+            mask = current.base.filter_mask(self.filters)
+            trie_matches = current.base.trie.titles_at(node, self.num_suggestions + 1, mask) if node >= 0 else []
+        suggestions, candidates = hybrid_suggestions(current, query, self.num_suggestions, candidates, trie_matches,
+                                                     filters=self.filters)
+        if candidates is not None and len(candidates) > SESSION_MAX_CANDIDATES:
+            candidates = None
+        state = (query, node, candidates, suggestions)
+        if prefix == query:
+            self.states[-1] = state
+        else:
+            self.states.append(state)
+        return suggestions
+
+# Suggestion stream: a WebSocket endpoint (ws://host:STREAM_PORT/suggest?type=Movie, taking
+# the filter parameters of /api/suggest) served by an asyncio server with
+# `python app.py stream`. A client sends {"seq": n, "q": "..."} on every keystroke over one
+# connection and gets {"seq": n, "suggestions": [...]} back. Only a session's newest query
+# is answered: queries arriving during a search replace each other, and a search already
+# running is not cancelled but its result is dropped when superseded. The stream process
+# loads its own catalog, so /api/catalog changes reach it only after a restart.
+STREAM_PORT = int(os.environ.get('STREAM_PORT', '5001'))
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_STREAM_MESSAGE = 4096
+
+def websocket_frame(opcode, payload=b''):
+    """An unmasked, final server frame"""
+    if len(payload) < 126:
+        header = bytes((0x80 | opcode, len(payload)))
+    elif len(payload) < 65536:
+        header = bytes((0x80 | opcode, 126)) + len(payload).to_bytes(2, 'big')
+    else:
+        header = bytes((0x80 | opcode, 127)) + len(payload).to_bytes(8, 'big')
+    return header + payload
+
+async def read_websocket_message(reader, writer):
+    """The next text message of a client, or None once it closes; answers pings on the way"""
+    message = b''
+    while True:
+        head = await reader.readexactly(2)
+        opcode, length = head[0] & 0x0F, head[1] & 0x7F
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), 'big')
+        if not head[1] & 0x80 or len(message) + length > MAX_STREAM_MESSAGE:
+            raise ValueError('Client frames must be masked and short')
+        mask = await reader.readexactly(4)
+        payload = await reader.readexactly(length)
+        payload = (int.from_bytes(payload, 'big') ^ int.from_bytes((mask * (length // 4 + 1))[:length], 'big')).to_bytes(length, 'big')
+        
+        if opcode == 0x8:
+            writer.write(websocket_frame(0x8, payload[:2]))
+            return None
+        if opcode == 0x9:
+            writer.write(websocket_frame(0xA, payload))
+        elif opcode in (0x0, 0x1, 0x2):
+            message += payload
+            if head[0] & 0x80:
+                return message.decode('utf-8')
+
+async def handle_stream(reader, writer):
+    try:
+        request_line, *header_lines = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        headers = {name.strip().lower(): value.strip()
+                   for name, _, value in (line.partition(':') for line in header_lines if line)}
+        target = urllib.parse.urlsplit(request_line.split(' ')[1] if ' ' in request_line else '')
+        if target.path != '/suggest' or headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return
+        accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'].encode('latin-1') + WEBSOCKET_GUID).digest())
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        
+        try:
+            filters = parse_filters(dict(urllib.parse.parse_qsl(target.query)))
+        except ValueError as e:
+            writer.write(websocket_frame(0x1, json.dumps({'error': str(e)}).encode('utf-8')))
+            writer.write(websocket_frame(0x8, (1008).to_bytes(2, 'big')))
+            return
+        session = SuggestionSession(filters=filters)
+        loop = asyncio.get_running_loop()
+        pending = None
+        wakeup = asyncio.Event()
+        
+        # Searches run one at a time per session, off the event loop, always for the newest query
+        async def answer():
+            while True:
+                await wakeup.wait()
+                wakeup.clear()
+                seq, text = pending
+                started = time.perf_counter()
+                try:
+                    suggestions = await loop.run_in_executor(None, session.suggest, text)
+                    superseded = pending[0] != seq
+                    metrics.observe_request('stream', 'hybrid', 'superseded' if superseded else 'miss',
+                                            time.perf_counter() - started)
+                    if not superseded:
+                        body = f'{{"seq": {seq}, "suggestions": {enriched_json(suggestions, session.generation)}}}'
+                        writer.write(websocket_frame(0x1, body.encode('utf-8')))
+                        await writer.drain()
+                except ConnectionError:
+                    return
+                except Exception:
+                    # A failed query must not silence the session: report it and start the
+                    # session's state afresh for the next one
+                    logger.exception(f"Stream query {text!r} failed")
+                    session.generation = None
+                    error = {'seq': seq, 'error': 'Could not get suggestions'}
+                    writer.write(websocket_frame(0x1, json.dumps(error).encode('utf-8')))
+        
+        answering = asyncio.create_task(answer())
+        try:
+            while (message := await read_websocket_message(reader, writer)) is not None:
+                try:
+                    query = json.loads(message)
+                    seq, text = int(query['seq']), str(query['q'])
+                except (ValueError, TypeError, KeyError):
+                    error = {'error': 'Expected {"seq": n, "q": "..."}'}
+                    writer.write(websocket_frame(0x1, json.dumps(error).encode('utf-8')))
+                    continue
+                pending = (seq, text)
+                wakeup.set()
+        finally:
+            answering.cancel()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+def serve_stream(host='127.0.0.1', port=STREAM_PORT):
+    async def main():
+        server = await asyncio.start_server(handle_stream, host, port)
+        print(f"Streaming suggestions on ws://{host}:{port}/suggest")
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
+# Worker processes serving requests (more than one only under serve_prefork)
+SERVING_WORKERS = 1
+
+# Production serving: the indexes are built or loaded once in this process, then moved out
+# of the cyclic GC's reach with gc.freeze so collections in the workers never write to
+# (and so copy) their pages. Workers are forked afterwards, share those pages copy-on-write
+# and accept connections from one listening socket. Dead workers are replaced.
+def serve_prefork(host='127.0.0.1', port=5000, workers=None, freeze=True):
+    global SERVING_WORKERS
+    workers = workers or os.cpu_count() or 1
+    SERVING_WORKERS = workers
+    listener = socket.create_server((host, port), backlog=1024)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No log line per request
+    
+    gc.collect()
+    if freeze:
+        gc.freeze()
+    
+    children = set()
+    stopping = False
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()  # Workers would otherwise sample the same requests for logging
+            try:
+                make_server(host, port, app, fd=listener.fileno()).serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"Serving on http://{host}:{port}/ with {workers} workers (pid {os.getpid()})")
+    
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, starting a new one")
+            spawn()
+    listener.close()
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['build-snapshot']:
+        parser = argparse.ArgumentParser(prog='app.py build-snapshot', description="Build the index snapshot from the CSV")
+        parser.add_argument('output', nargs='?', default=SNAPSHOT_PATH)
+        parser.add_argument('--workers', type=int, default=BUILD_WORKERS, help="build processes (the result is the same)")
+        args = parser.parse_args(sys.argv[2:])
+        
+        # Always rebuild from the CSV, never from an existing snapshot
+        started = time.perf_counter()
+        built_titles, built_metadata, built_fields = load_netflix_data(workers=args.workers)
+        if not built_metadata:
+            sys.exit("Could not load the catalog CSV, not writing a snapshot")
+        build_timings = {'load': time.perf_counter() - started}
+        SearchIndex.build(built_titles, built_metadata, built_fields, workers=args.workers,
+                          timings=build_timings).save(args.output)
+        print(f"Wrote index snapshot {args.output} ({os.path.getsize(args.output)} bytes) in "
+              f"{time.perf_counter() - started:.2f}s with {args.workers} workers")
+        print(', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in build_timings.items()))
+        sys.exit(0)
+    
+    if sys.argv[1:2] == ['serve']:
+        parser = argparse.ArgumentParser(prog='app.py serve', description="Serve with pre-forked workers")
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=1 if SHARD_COUNT > 1 else os.cpu_count() or 1)
+        parser.add_argument('--no-freeze', action='store_true', help="leave the indexes to the cyclic GC")
+        args = parser.parse_args(sys.argv[2:])
+        logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
+        if SHARD_COUNT > 1:
+            # One threaded coordinator; the shard processes do the work in parallel
+            if args.workers > 1:
+                sys.exit("Sharded mode serves from one coordinator process, use --workers 1")
+            started = time.perf_counter()
+            shards = get_shard_set()
+            print(f"Started {SHARD_COUNT} shards ({sum(shards.titles)} titles) in {time.perf_counter() - started:.2f}s")
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            print(f"Serving on http://{args.host}:{args.port}/ as the coordinator of {SHARD_COUNT} shards")
+            make_server(args.host, args.port, app, threaded=True).serve_forever()
+            sys.exit(0)
+        serve_prefork(args.host, args.port, args.workers, freeze=not args.no_freeze)
+        sys.exit(0)
+    
+    if sys.argv[1:2] == ['stream']:
+        parser = argparse.ArgumentParser(prog='app.py stream', description="Serve the WebSocket suggestion stream")
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=STREAM_PORT)
+        args = parser.parse_args(sys.argv[2:])
+        if SHARD_COUNT > 1:
+            sys.exit("The suggestion stream walks the local trie and is not available in sharded mode")
+        serve_stream(args.host, args.port)
+        sys.exit(0)
+    
+    if '--metadata-memory-report' in sys.argv:
+        for key, value in metadata_memory_report().items():
+            print(f"{key}: {value}")
+        sys.exit(0)
+    
+    if '--trie-memory-report' in sys.argv:
+        for key, value in trie_memory_report(catalog.titles).items():
+            print(f"{key}: {value}")
+        sys.exit(0)
+    
+    if '--semantic-recall-report' in sys.argv:
+        for key, value in semantic_recall_report(catalog.base).items():
+            print(f"{key}: {value}")
+        sys.exit(0)
+    
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s')
     print("Netflix Autocomplete backend started!")
     print("Visit http://localhost:5000/ in your browser")
     app.run(debug=True)
\ No newline at end of file
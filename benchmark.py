@@ -0,0 +1,391 @@
+# Benchmarks: benchmark.py
+# Offline benchmark for index build time, suggestion latency and memory.
+#
+#   python benchmark.py                                # bundled catalog, writes benchmark_results.json
+#   python benchmark.py --scales 1 10 100              # also synthetic catalogs 10x and 100x the size
+#   python benchmark.py --baseline baseline.json       # exit 1 on regressions against a stored run
+#   python benchmark.py --serving --workers 1 2 4      # pre-fork server throughput and worker memory
+#   python benchmark.py --parallel-build --workers 1 2 4  # build phase timings and speedup per worker count
+import argparse
+import gc
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from urllib.parse import urlencode
+
+import numpy as np
+
+import app
+
+PERCENTILES = (50, 95, 99)
+
+# Metrics compared against a baseline (lower is better)
+REGRESSION_METRICS = ('build_seconds.total', 'latency_ms.end_to_end.p50', 'latency_ms.end_to_end.p95',
+                      'latency_ms.end_to_end.p99', 'peak_build_memory_mb')
+
+# Grow the catalog with made-up titles built from words of the real ones, keeping their
+# metadata and searchable fields
+def synthetic_catalog(titles, title_metadata, title_fields, scale, seed):
+    if scale <= 1:
+        return titles, title_metadata, title_fields
+
+    rng = random.Random(seed)
+    vocabulary = sorted({word for title in titles for word in title.split()})
+    catalog_titles = list(titles)
+    catalog_metadata = dict(title_metadata)
+    catalog_fields = dict(title_fields)
+    seen = set(titles)
+    while len(catalog_titles) < len(titles) * scale:
+        source = rng.choice(titles)
+        words = source.split()
+        words.insert(rng.randrange(len(words) + 1), rng.choice(vocabulary))
+        title = " ".join(words)
+        if title not in seen:
+            seen.add(title)
+            catalog_titles.append(title)
+            if source in title_metadata:
+                catalog_metadata[title] = dict(title_metadata[source], title=title)
+            if source in title_fields:
+                catalog_fields[title] = title_fields[source]
+
+    catalog_titles.sort(key=len)
+    return catalog_titles, catalog_metadata, catalog_fields
+
+# Keystroke replay: every prefix of sampled titles (first two words), plus typos and mid-title words
+def keystroke_queries(titles, count, seed):
+    rng = random.Random(seed)
+    queries = []
+    for title in rng.sample(titles, min(count, len(titles))):
+        typed = " ".join(title.split()[:2])
+        queries.extend(typed[:end] for end in range(1, len(typed) + 1))
+
+        # A swapped pair of letters
+        if len(typed) > 4:
+            i = rng.randrange(1, len(typed) - 2)
+            queries.append(typed[:i] + typed[i+1] + typed[i] + typed[i+2:])
+
+        # A later word on its own
+        words = title.split()
+        if len(words) > 2:
+            queries.append(words[-1][:5])
+    return queries
+
+def percentiles(samples):
+    values = np.percentile(np.array(samples) * 1000, PERCENTILES) if samples else [0.0] * len(PERCENTILES)
+    return {f'p{p}': round(float(value), 4) for p, value in zip(PERCENTILES, values)}
+
+# Time each index builder on its own, then the whole SearchIndex and its peak traced memory
+def benchmark_build(titles, title_metadata, title_fields):
+    timings = {}
+    builders = (
+        ('trie', lambda: app.AutocompleteTrie(titles)),
+        ('ngram', lambda: app.NgramModel().train(titles)),
+        ('substring', lambda: app.SubstringIndex(titles)),
+        ('tfidf', lambda: app.TfidfRanker(titles)),
+        ('fuzzy', lambda: app.FuzzyIndex(titles)),
+        ('fields', lambda: app.FieldIndex(titles, title_fields)),
+        ('semantic', lambda: app.SemanticIndex(titles, title_fields)),
+    )
+    for name, build in builders:
+        gc.collect()
+        started = time.perf_counter()
+        build()
+        timings[name] = round(time.perf_counter() - started, 4)
+
+    gc.collect()
+    started = time.perf_counter()
+    index = app.SearchIndex.build(titles, title_metadata, title_fields)
+    timings['total'] = round(time.perf_counter() - started, 4)
+
+    # Traced separately, tracemalloc slows allocation-heavy builds several times over
+    gc.collect()
+    tracemalloc.start()
+    app.SearchIndex.build(titles, title_metadata, title_fields)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return index, timings, peak
+
+# Replay the queries through generate_suggestions and enriched_json, recording each stage
+def benchmark_queries(generation, queries, mode, repeat):
+    stages = {}
+    suggest_samples, metadata_samples, end_to_end_samples = [], [], []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            for query in queries:
+                timings = {}
+                started = time.perf_counter()
+                suggestions = app.generate_suggestions(query, mode=mode, generation=generation, timings=timings)
+                suggested = time.perf_counter()
+                app.enriched_json(suggestions, generation)
+                finished = time.perf_counter()
+
+                suggest_samples.append(suggested - started)
+                metadata_samples.append(finished - suggested)
+                end_to_end_samples.append(finished - started)
+                for stage, seconds in timings.items():
+                    stages.setdefault(stage, []).append(seconds)
+
+    latency = {stage: dict(percentiles(samples), runs=len(samples)) for stage, samples in stages.items()}
+    latency['suggestions'] = percentiles(suggest_samples)
+    latency['metadata'] = percentiles(metadata_samples)
+    latency['end_to_end'] = percentiles(end_to_end_samples)
+    return latency
+
+def run(args):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        titles, title_metadata, title_fields = app.load_netflix_data(args.data)
+    if not title_metadata:
+        sys.exit(f"Could not load {args.data}")
+
+    results = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()},
+        'settings': {'data': args.data, 'queries': args.queries, 'seed': args.seed, 'repeat': args.repeat, 'mode': args.mode},
+        'catalogs': {}
+    }
+    for scale in args.scales:
+        catalog_titles, catalog_metadata, catalog_fields = synthetic_catalog(titles, title_metadata, title_fields,
+                                                                             scale, args.seed)
+        print(f"Catalog x{scale}: {len(catalog_titles)} titles")
+
+        index, build_seconds, peak = benchmark_build(catalog_titles, catalog_metadata, catalog_fields)
+        queries = keystroke_queries(catalog_titles, args.queries, args.seed)
+        latency = benchmark_queries(app.Catalog(index), queries, args.mode, args.repeat)
+        results['catalogs'][f'x{scale}'] = {
+            'titles': len(catalog_titles),
+            'queries': len(queries),
+            'build_seconds': build_seconds,
+            'peak_build_memory_mb': round(peak / 2**20, 2),
+            'latency_ms': latency
+        }
+        print(f"  build {build_seconds['total']:.2f}s, peak {peak / 2**20:.1f} MB, "
+              f"end-to-end p50 {latency['end_to_end']['p50']:.3f} ms, p99 {latency['end_to_end']['p99']:.3f} ms")
+        if 'trie' in latency:
+            # Queries whose top k was settled by the trie skip the n-gram stage
+            print(f"  n-gram stage ran for {latency.get('ngram', {}).get('runs', 0)} of {latency['trie']['runs']} hybrid queries")
+        del index
+        gc.collect()
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['max_rss_mb'] = round(max_rss / (2**20 if sys.platform == 'darwin' else 2**10), 2)
+    return results
+
+# Ids of the processes whose parent is pid, from /proc (Linux only)
+def child_pids(pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+# Resident, proportional and private (not shared with any other process) memory in MB
+def process_memory(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                values[key] = int(value.split()[0]) / 1024
+    return {'rss_mb': round(values.get('Rss', 0), 1), 'pss_mb': round(values.get('Pss', 0), 1),
+            'private_mb': round(values.get('Private_Clean', 0) + values.get('Private_Dirty', 0), 1)}
+
+# One client sending queries back to back until the deadline; returns the requests completed
+def drive_load(port, queries, duration, offset):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    completed = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        query = queries[(offset + completed) % len(queries)]
+        connection.request('GET', '/api/suggest?' + urlencode({'q': query}))
+        connection.getresponse().read()
+        completed += 1
+    connection.close()
+    return completed
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Start `app.py serve`, wait for it to answer, drive it with concurrent clients, then read
+# the memory of each worker
+def benchmark_server(args, workers, queries, freeze=True):
+    port = free_port()
+    command = [sys.executable, 'app.py', 'serve', '--workers', str(workers), '--port', str(port)]
+    if not freeze:
+        command.append('--no-freeze')
+    server = subprocess.Popen(command, env=dict(os.environ, NETFLIX_CATALOG=args.data),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 300
+        while True:
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                connection.request('GET', '/api/suggest?q=st')
+                connection.getresponse().read()
+                connection.close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    sys.exit(f"app.py serve did not start (exit code {server.poll()})")
+                time.sleep(0.2)
+        
+        clients = args.clients or 2 * workers
+        with ProcessPoolExecutor(clients) as pool:
+            counts = list(pool.map(drive_load, [port] * clients, [queries] * clients, [args.duration] * clients,
+                                   [i * len(queries) // clients for i in range(clients)]))
+        memory = [process_memory(pid) for pid in child_pids(server.pid)]
+        return {
+            'workers': workers,
+            'freeze': freeze,
+            'clients': clients,
+            'requests_per_second': round(sum(counts) / args.duration, 1),
+            'parent': process_memory(server.pid),
+            'worker_memory': memory,
+            'mean_worker_private_mb': round(sum(m['private_mb'] for m in memory) / max(len(memory), 1), 1)
+        }
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+
+# Throughput and per-worker private memory across worker counts, plus the largest count
+# without gc.freeze for comparison
+def run_serving(args):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        titles = app.load_netflix_data(args.data)[0]
+    queries = keystroke_queries(titles, args.queries, args.seed)
+    
+    runs = [(workers, True) for workers in args.workers] + [(max(args.workers), False)]
+    results = {'cpus': os.cpu_count(), 'duration': args.duration, 'runs': []}
+    for workers, freeze in runs:
+        run_results = benchmark_server(args, workers, queries, freeze)
+        results['runs'].append(run_results)
+        print(f"{workers} workers{'' if freeze else ' (no gc.freeze)'}: {run_results['requests_per_second']} req/s, "
+              f"private memory per worker {run_results['mean_worker_private_mb']} MB")
+    return results
+
+# Load and build the catalog with each worker count, recording the phase timings, the
+# speedup over one worker, and whether every index array matches the serial build byte for byte
+def run_parallel_build(args):
+    results = {'cpus': os.cpu_count(), 'runs': []}
+    serial = None
+    for workers in sorted(set([1] + args.workers)):
+        gc.collect()
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            titles, title_metadata, title_fields = app.load_netflix_data(args.data, workers=workers)
+        timings = {'load': time.perf_counter() - started}
+        index = app.SearchIndex.build(titles, title_metadata, title_fields, workers=workers, timings=timings)
+        total = time.perf_counter() - started
+        
+        arrays = {name: np.ascontiguousarray(array) for name, array in index.to_arrays().items()}
+        if serial is None:
+            serial = {'total': total, 'arrays': arrays}
+        identical = arrays.keys() == serial['arrays'].keys() and all(
+            array.dtype == serial['arrays'][name].dtype and array.tobytes() == serial['arrays'][name].tobytes()
+            for name, array in arrays.items())
+        run_results = {
+            'workers': workers,
+            'total_seconds': round(total, 3),
+            'speedup': round(serial['total'] / total, 2),
+            'identical': identical,
+            'phases': {phase: round(seconds, 3) for phase, seconds in timings.items()}
+        }
+        results['runs'].append(run_results)
+        phases = ', '.join(f'{phase} {seconds}s' for phase, seconds in run_results['phases'].items())
+        print(f"{workers} workers: {run_results['total_seconds']}s, speedup {run_results['speedup']}x, "
+              f"{'identical' if identical else 'DIFFERENT'} ({phases})")
+    return results
+
+def lookup(results, path):
+    value = results
+    for key in path.split('.'):
+        value = value[key]
+    return value
+
+# Metrics that got worse than the baseline by more than the tolerance
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, catalog_results in results['catalogs'].items():
+        if name not in baseline.get('catalogs', {}):
+            continue
+        for metric in REGRESSION_METRICS:
+            try:
+                before = lookup(baseline['catalogs'][name], metric)
+                after = lookup(catalog_results, metric)
+            except KeyError:
+                continue
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {before} -> {after} (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark index builds and suggestion latency")
+    parser.add_argument('--data', default='data/netflix_titles.csv', help="catalog CSV")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1], help="catalog size multipliers, e.g. 1 10 100")
+    parser.add_argument('--queries', type=int, default=200, help="titles to replay keystrokes for")
+    parser.add_argument('--repeat', type=int, default=1, help="replays of the query set")
+    parser.add_argument('--mode', default='hybrid', choices=app.SUGGESTION_MODES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="earlier results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before failing (0.2 = 20%%)")
+    parser.add_argument('--serving', action='store_true', help="benchmark `app.py serve` instead of the indexes")
+    parser.add_argument('--parallel-build', action='store_true', help="benchmark parallel index builds")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help="worker counts for --serving and --parallel-build")
+    parser.add_argument('--clients', type=int, help="concurrent clients for --serving (default 2 per worker)")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load per --serving run")
+    args = parser.parse_args()
+
+    if args.serving:
+        results = run_serving(args)
+        with open(args.output, 'w') as f:
+            json.dump({'serving': results}, f, indent=2)
+        print(f"Wrote {args.output}")
+        return
+
+    if args.parallel_build:
+        results = run_parallel_build(args)
+        with open(args.output, 'w') as f:
+            json.dump({'parallel_build': results}, f, indent=2)
+        print(f"Wrote {args.output}")
+        if not all(run_results['identical'] for run_results in results['runs']):
+            sys.exit("Parallel builds differ from the serial build")
+        return
+
+    results = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == '__main__':
+    main()